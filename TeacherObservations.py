@@ -24,26 +24,428 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 import csv
+import sys
+import Queue
+import threading
+import time
+import urllib
+import glob
 import argparse
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import binascii
+import cgi
+import contextlib
+import cProfile
+import hashlib
+import itertools
+import marshal
+import mmap
+import multiprocessing
+import operator
+import string
+import struct
+from cStringIO import StringIO
+import os
 import os.path
-from collections import defaultdict, Counter, OrderedDict
+import random
+from collections import defaultdict, Counter, OrderedDict, Mapping, namedtuple
 from pprint import pprint
 
+
+def popcount(value):
+    """
+    Count the number of set bits in an integer bitmask
+
+    >>> popcount(0b101101)
+    4
+    """
+    return bin(value).count('1')
+
+
+def set_bits(value):
+    """
+    The positions of the set bits in an integer bitmask, lowest first
+
+    >>> list(set_bits(0b101100))
+    [2, 3, 5]
+    """
+    while value:
+        lowest = value & -value
+        yield lowest.bit_length() - 1
+        value ^= lowest
+
+
+# Functions called with (stage, record) whenever an instrumented stage finishes
+_timing_hooks = []
+# The stage to run under cProfile, and the profiler for it
+_profiled_stage = None
+_profiler = None
+_profile_file = None
+
+
+def add_timing_hook(hook):
+    """
+    Call hook(stage, record) every time an instrumented stage finishes.  The stages are
+    read, parse_categories, parse_rows, cache_load, compare and html, and the record is a dict
+    with the wall time in seconds plus whatever the stage counts (rows, cells, bytes_read,
+    output_bytes).
+    """
+    _timing_hooks.append(hook)
+
+
+def remove_timing_hook(hook):
+    _timing_hooks.remove(hook)
+
+
+def profile_stage(stage, filename):
+    """
+    Run every call of one stage under cProfile, dumping the accumulated stats to filename
+    after each call.  Pass None as the stage to stop profiling.
+    """
+    global _profiled_stage, _profiler, _profile_file
+    _profiled_stage = stage
+    _profiler = cProfile.Profile() if stage is not None else None
+    _profile_file = filename
+
+
+def timing_enabled():
+    """
+    Whether any stage is being timed or profiled
+    """
+    return bool(_timing_hooks) or _profiled_stage is not None
+
+
+@contextlib.contextmanager
+def timed_stage(stage, **counters):
+    """
+    Time a stage for the timing hooks.  Yields the record, so counters can be added to it.
+    When there are no hooks and nothing is being profiled, this does nothing.
+    """
+    record = dict(counters)
+    if not timing_enabled():
+        yield record
+        return
+    profiler = _profiler if stage == _profiled_stage else None
+    start = time.time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(_profile_file)
+        record['seconds'] = time.time() - start
+        for hook in _timing_hooks:
+            hook(stage, record)
+
+
+class StageTimings(object):
+    """
+    A timing hook which adds up the time, calls and counters for each stage.  It can be shared
+    between threads, but stages which run in other processes aren't seen.
+
+        timings = StageTimings()
+        add_timing_hook(timings)
+        ...
+        print timings.to_json()
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __call__(self, stage, record):
+        with self.lock:
+            totals = self.stages.setdefault(stage, Counter())
+            totals['calls'] += 1
+            totals.update(record)
+
+    def to_json(self):
+        import json
+        return json.dumps(self.stages, indent=2)
+
+
+def category_columns(categories):
+    """
+    Flatten the categories OrderedDict into a list of (category, observation) columns,
+    in the same order as the spreadsheet
+    """
+    columns = []
+    for category, observations in categories.iteritems():
+        for observation in observations:
+            columns.append((category, observation))
+    return columns
+
+
+# Turns the '0' and '1' digits of a binary string into bytes 0 and 1
+_DIGIT_VALUES = string.maketrans('01', '\x00\x01')
+
+
+class ObservationMatrix(object):
+    """
+    A compact time block x code matrix.
+
+    Every code (category, observation pair) is a column, and each column is stored as a single
+    integer bitmask where bit i is set if the code was marked in time block i.  The column index
+    is built from the categories OrderedDict returned by TeacherObservation.parse_categories, so
+    the columns come out in the same order as the spreadsheet.
+    """
+    def __init__(self, categories):
+        self.columns = category_columns(categories)
+        self.column_index = dict((column, index) for index, column in enumerate(self.columns))
+        self.rows = 0
+        self.bits = [0] * len(self.columns)
+
+    def append_marked(self, marked):
+        """
+        Add a time block, given the indexes of the columns which were marked in it
+        """
+        row_bit = 1 << self.rows
+        bits = self.bits
+        for index in marked:
+            bits[index] |= row_bit
+        self.rows += 1
+
+    def column(self, index):
+        """
+        Return a column as a list of 0/1 values, like the old results lists
+        
+        >>> matrix = ObservationMatrix({'1. Instructor': ['Lec']})
+        >>> matrix.append_marked([0]); matrix.append_marked([]); matrix.append_marked([0])
+        >>> matrix.column(0)
+        [1, 0, 1]
+        """
+        if not self.rows:
+            return []
+        # Read the bits from a binary string (the reverse of from_results), so this stays
+        # linear in the number of rows rather than shifting the whole bitmask for each one
+        return list(bytearray(bin(self.bits[index])[2:].zfill(self.rows)[::-1].translate(_DIGIT_VALUES)))
+
+    def count(self, index):
+        """
+        How many time blocks were marked for this column
+        """
+        return popcount(self.bits[index])
+
+    @property
+    def row_bytes(self):
+        """
+        The number of bytes needed to bit-pack one column
+        """
+        return (self.rows + 7) // 8
+
+    @staticmethod
+    def column_bytes(value, width):
+        """
+        Pack a column bitmask into width bytes, with time block 0 in the lowest bit of the first byte
+        
+        >>> ObservationMatrix.column_bytes(0b100000001, 2)
+        '\\x01\\x01'
+        >>> ObservationMatrix.bytes_column('\\x01\\x01') == 0b100000001
+        True
+        """
+        if not width:
+            return ''
+        return binascii.unhexlify(('%x' % value).zfill(width * 2))[::-1]
+
+    @staticmethod
+    def bytes_column(chunk):
+        """
+        Unpack the output of column_bytes back into a bitmask
+        """
+        return int(binascii.hexlify(chunk[::-1]), 16) if chunk else 0
+
+    def to_bytes(self):
+        """
+        Bit-pack the matrix into a bytes buffer.  Columns are stored one after the other, each
+        taking row_bytes bytes, with time block 0 in the lowest bit of the first byte.
+        """
+        width = self.row_bytes
+        return ''.join([self.column_bytes(value, width) for value in self.bits])
+
+    @classmethod
+    def from_bytes(cls, categories, rows, buf):
+        """
+        Rebuild a matrix from the output of to_bytes
+        """
+        matrix = cls(categories)
+        matrix.rows = rows
+        width = matrix.row_bytes
+        for index in xrange(len(matrix.columns)):
+            chunk = buf[index * width:(index + 1) * width]
+            matrix.bits[index] = cls.bytes_column(chunk)
+        return matrix
+
+    @classmethod
+    def from_results(cls, categories, results, rows):
+        """
+        Build a matrix from the dict of lists layout of TeacherObservation.results
+        """
+        matrix = cls(categories)
+        matrix.rows = rows
+        for index, (category, observation) in enumerate(matrix.columns):
+            # Build the bitmask from a binary string, so this stays linear in the number of rows
+            series = ''.join(['1' if marked else '0' for marked in reversed(results[category][observation])])
+            matrix.bits[index] = int(series, 2) if series else 0
+        return matrix
+
+    def occupied_rows(self):
+        """
+        A bitmask of the time blocks which have anything marked at all
+        """
+        occupied = 0
+        for value in self.bits:
+            occupied |= value
+        return occupied
+
+
+class CompactCategoryResults(Mapping):
+    """
+    A read-only view of one broad category of an ObservationMatrix, mapping each observation
+    to a list of 0/1 values
+    """
+    def __init__(self, matrix, category, observations):
+        self.matrix = matrix
+        self.category = category
+        self.observations = observations
+
+    def __getitem__(self, observation):
+        return self.matrix.column(self.matrix.column_index[(self.category, observation)])
+
+    def __iter__(self):
+        return iter(self.observations)
+
+    def __len__(self):
+        return len(self.observations)
+
+
+class CompactResults(Mapping):
+    """
+    A read-only view of an ObservationMatrix which looks like the results dict,
+    so results[category][observation] still gives a list of 0/1 values
+    """
+    def __init__(self, matrix, categories):
+        self.matrix = matrix
+        self.categories = categories
+
+    def __getitem__(self, category):
+        return CompactCategoryResults(self.matrix, category, self.categories[category])
+
+    def __iter__(self):
+        return iter(self.categories)
+
+    def __len__(self):
+        return len(self.categories)
+
+
+class HeaderSchema(object):
+    """
+    A compiled version of an observation file's header rows.
+    
+    Besides the categories from TeacherObservation.parse_categories, it holds the csv position of
+    every (category, observation) column, so a row can be decoded without walking the categories.
+    Use compile_schema to get one, since files with the same header share the same schema.
+    """
+    def __init__(self, header_broad_categories, header_observation_categories):
+        self.categories = TeacherObservation.parse_categories(header_broad_categories, header_observation_categories)
+        self.columns = category_columns(self.categories)
+        # Find the csv positions of each category's observations, the same way parse_categories does
+        positions = defaultdict(list)
+        last_category = 'Time'
+        for position, category in enumerate(header_broad_categories):
+            if category != '':
+                last_category = category
+            if last_category != 'Time' and not last_category.startswith('Comment'):
+                positions[last_category].append(position)
+        self.positions = []
+        for category, observations in self.categories.iteritems():
+            self.positions.extend(positions[category])
+        if len(self.positions) == 1:
+            position = self.positions[0]
+            self.cells = lambda line: (line[position],)
+        elif self.positions:
+            self.cells = operator.itemgetter(*self.positions)
+        else:
+            self.cells = lambda line: ()
+
+    def copy_categories(self):
+        """
+        A copy of the categories for one observation to keep.  Schemas are shared by every file
+        with the same header, so their categories mustn't be changed.
+        """
+        return OrderedDict((category, list(observations)) for category, observations in self.categories.iteritems())
+
+    def marked(self, line):
+        """
+        The indexes of the columns which are marked in a row.  Only the cells which aren't empty
+        get looked at any closer.
+        """
+        return [index for index, value in enumerate(self.cells(line)) if value and not value.isspace()]
+
+    def decode(self, line):
+        """
+        Decode a row into a bitmask of the marked columns
+        """
+        codes = 0
+        for index in self.marked(line):
+            codes |= 1 << index
+        return codes
+
+
+# Compiled schemas, keyed by the header rows
+_schema_cache = {}
+
+def compile_schema(header_broad_categories, header_observation_categories):
+    """
+    Get the HeaderSchema for a pair of header rows, compiling it only the first time it is seen
+    """
+    key = (tuple(header_broad_categories), tuple(header_observation_categories))
+    schema = _schema_cache.get(key)
+    if schema is None:
+        if len(_schema_cache) >= 256:
+            _schema_cache.clear()
+        schema = _schema_cache[key] = HeaderSchema(header_broad_categories, header_observation_categories)
+    return schema
+
+
+def cached_summary(function):
+    """
+    A read-only property which is worked out the first time it is asked for and then kept in
+    the observation's summary_cache, which is cleared whenever the results are reset
+    """
+    name = function.__name__
+    def get(self):
+        try:
+            return self.summary_cache[name]
+        except KeyError:
+            value = self.summary_cache[name] = function(self)
+            return value
+    return property(get, doc=function.__doc__)
+
+
 class TeacherObservation(object):
     """
     An object which is designed to parse and interpret a teacher eval
+
+    If compact is True, the parsed results are kept in an ObservationMatrix and results is a
+    read-only view over it, which uses a fraction of the memory of the dict of lists.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, compact=False):
         if not os.path.exists(filename):
             raise IOError("File does not exist")
         else:
             self.filename = filename
+            self.compact = compact
             self.initialize_results()
     
     def initialize_results(self):
         self.categories = []
         self.times = []
         self.results = []
+        self.matrix = None
+        self.summary_cache = {}
             
     @staticmethod    
     def parse_categories(header_broad_categories, header_observation_categories):
@@ -90,282 +492,1982 @@ class TeacherObservation(object):
                 
         
     
-    def parse(self):
+    @classmethod
+    def read_header(cls, csvfile):
         """
-        Parse the file
+        Read the header lines from an open observation file.
+        Returns a csv reader positioned at the first time block, and the compiled HeaderSchema.
         """
-        self.initialize_results()
-        with open(self.filename, 'rb') as csvfile:
+        with timed_stage('parse_categories'):
             # The first line is not used, discard it
             csvfile.readline()
             # Set up the csv reader
             reader = csv.reader(csvfile)
-            # Retrieve the broad categories from the next line
-            header_broad_categories = reader.next()
-            # Get the specific categories
-            header_observation_categories = reader.next()
+            try:
+                # Retrieve the broad categories from the next line
+                header_broad_categories = reader.next()
+                # Get the specific categories
+                header_observation_categories = reader.next()
+            except StopIteration:
+                # Don't let a short file look like the end of whatever loop is reading it
+                raise ValueError("The file is missing its header rows")
             # Parse these categories
-            self.categories = self.parse_categories(header_broad_categories, header_observation_categories)
-            
-            # Set up the results object
+            return reader, compile_schema(header_broad_categories, header_observation_categories)
+
+    @staticmethod
+    def read_rows(reader):
+        """
+        Generate (time, line) for each time block, where time is the start of the time range
+        """
+        for line in reader:
+            # Time must always be first
+            time_block = line[0]
+            # Skip any lines without something in the minute field, as these are presumed to be just headers
+            if time_block != '':
+                # get rid of the ranges, so we could analyze or plot these data
+                yield time_block.split('-')[0].strip(), line
+
+    def get_matrix(self):
+        """
+        Return the results as an ObservationMatrix.  When the results are stored as lists, the
+        matrix is built the first time it is asked for and kept until the file is parsed again.
+        """
+        if self.matrix is None:
+            self.matrix = ObservationMatrix.from_results(self.categories, self.results, len(self.times))
+        return self.matrix
+
+    @classmethod
+    def from_matrix(cls, filename, categories, times, matrix, compact=True):
+        """
+        Create an observation from an already parsed ObservationMatrix.  The file doesn't have
+        to exist, so this can be used for observations read back out of an archive.
+        """
+        observation = cls.__new__(cls)
+        observation.filename = filename
+        observation.compact = compact
+        observation.load_matrix(categories, times, matrix)
+        return observation
+
+    @cached_summary
+    def occupied_rows(self):
+        """
+        A bitmask of the time blocks which have anything marked at all
+        """
+        return self.get_matrix().occupied_rows()
+
+    @cached_summary
+    def filled_time_intervals(self):
+        """
+        How many time blocks have anything marked, like count_filled_time_intervals
+        """
+        return popcount(self.occupied_rows)
+
+    @cached_summary
+    def code_counts(self):
+        """
+        How many time blocks each code was marked in, keyed by (category, observation)
+        """
+        matrix = self.get_matrix()
+        return OrderedDict((column, popcount(bits)) for column, bits in zip(matrix.columns, matrix.bits))
+
+    @cached_summary
+    def category_totals(self):
+        """
+        The total number of marks in each broad category
+        """
+        totals = OrderedDict((category, 0) for category in self.categories)
+        for (category, observation), count in self.code_counts.iteritems():
+            totals[category] += count
+        return totals
+
+    def load_matrix(self, categories, times, matrix):
+        """
+        Fill in the results from an already parsed ObservationMatrix, such as one read back from
+        a cache, instead of parsing the file
+        """
+        self.initialize_results()
+        self.categories = categories
+        self.times = times
+        self.matrix = matrix
+        if self.compact:
+            self.results = CompactResults(matrix, categories)
+        else:
             self.results = {}
-            for category in self.categories.keys():
-                if category != '':
-                    self.results[category] = defaultdict(list)
-            #reader = csv.DictReader(csvfile, fieldnames = self.categories)
-            for line in reader:
-                
-                # Time must always be first
-                time_block = line[0]
-                # Skip any lines without something in the minute field, as these are presumed to be just headers
-                if time_block != '':
-                    # get rid of the ranges, so we could analyze or plot these data
-                    time_block_first_digit = time_block.split('-')[0].strip()
+            for category, observations in categories.iteritems():
+                self.results[category] = defaultdict(list)
+                for observation in observations:
+                    self.results[category][observation] = matrix.column(matrix.column_index[(category, observation)])
+
+    def parse(self, cache=None):
+        """
+        Parse the file
+        
+        If a ParseCache is given, the results are loaded from it when the file hasn't changed
+        since it was cached, and stored in it otherwise.
+        """
+        if cache is not None and cache.load(self):
+            return
+        if timing_enabled():
+            # Read the whole file first, so reading and parsing can be timed separately
+            with timed_stage('read') as record:
+                with open(self.filename, 'rb') as csvfile:
+                    data = csvfile.read()
+                record['bytes_read'] = len(data)
+            self.parse_file(StringIO(data))
+        else:
+            with open(self.filename, 'rb') as csvfile:
+                self.parse_file(csvfile)
+        if cache is not None:
+            cache.store(self)
+
+    @classmethod
+    def from_file(cls, filename, csvfile, compact=False):
+        """
+        Create an observation by parsing an already open file, such as the contents of filename
+        which have been read into memory.  The file isn't checked for or opened again.
+        """
+        observation = cls.__new__(cls)
+        observation.filename = filename
+        observation.compact = compact
+        observation.parse_file(csvfile)
+        return observation
+
+    def parse_file(self, csvfile):
+        """
+        Parse an open observation file
+        """
+        self.initialize_results()
+        reader, schema = self.read_header(csvfile)
+        self.categories = schema.copy_categories()
+
+        with timed_stage('parse_rows') as record:
+            # Set up the results object
+            if self.compact:
+                self.matrix = ObservationMatrix(self.categories)
+                self.results = CompactResults(self.matrix, self.categories)
+                for time_block, line in self.read_rows(reader):
                     # The times are stored in a list
-                    self.times.append(time_block_first_digit)
-                    
-                    # Initialize our parsing
-                    result_position = 1
-                    
-                    # Iterate over the categories
-                    for category, obs in self.categories.iteritems():
-                        # Iterate over the observations
-                        for observation in obs:
-                            
-                            value=line[result_position]
-                            if value.strip() == '':
-                                value = 0
-                            else:
-                                value = 1
-                            # Build up the results
-                            self.results[category][observation].append(value)
-                            # Move on to the next position
-                            result_position += 1
-                                    
+                    self.times.append(time_block)
+                    self.matrix.append_marked(schema.marked(line))
+            else:
+                self.results = {}
+                for category in self.categories.keys():
+                    if category != '':
+                        self.results[category] = defaultdict(list)
+                # Line up the result lists with the schema's columns
+                appends = [self.results[category][observation].append for category, observation in schema.columns]
+                for time_block, line in self.read_rows(reader):
+                    # The times are stored in a list
+                    self.times.append(time_block)
+                    # Build up the results
+                    for append, value in zip(appends, schema.cells(line)):
+                        if value and not value.isspace():
+                            append(1)
+                        else:
+                            append(0)
+            record['rows'] = len(self.times)
+            record['cells'] = len(self.times) * len(schema.columns)
 
-def count_filled_time_intervals(observations):
-    """
-    We want to count how many time intervals were actually filled out - that means 
-    that it is non-zero for any observation 
+
+def _write_example(directory, name='session.csv', rows=('0,x,,x,', '2,,x,,', '4,x,x,,ok'),
+                   header=(',1. Instructor,,2. Students,Comments', 'MIN,Lec,CQ,L,')):
     """
-    # Put all the observations together:
-    obs = zip(*observations)
-    
-    # Count up the intervals that have anything filled out
-    return sum([1 for x in obs if any(x) is True])
-    
-    
-def compare_teacher_evals(eval1, eval2):
+    Write a small observation file for the doctests and return its path
     """
-    Returns a Counter with the following keys:
-    both, neither, first, second
+    filename = os.path.join(directory, name)
+    with open(filename, 'w') as f:
+        f.write('Observer: example\n')
+        f.write(''.join(line + '\n' for line in header + tuple(rows)))
+    return filename
+
+
+class ParseCache(object):
     """
+    An on-disk cache of parsed observations, so files which haven't changed don't have to be
+    parsed again.
     
+    Entries are keyed on the absolute path of the observation file plus its modification time
+    and size (or a hash of its contents if use_hash is True), so an entry goes stale as soon as
+    the file changes, and stale entries are removed when the file is next loaded or stored.
+    Each entry holds the categories, times and bit-packed ObservationMatrix in marshal format.
+    When the cache grows past max_bytes, the least recently used entries are removed.
     
-    assert eval1.categories == eval2.categories, \
-    "The categories do not match, I can't compare these\nEval1 Categories: %s\nEval2 Categories: %s" % (eval1.categories, eval2.categories)
-    assert eval1.times == eval2.times, \
-    "The times do not match, I can't compare these.\nEval1 times: %s\nEvan2 times: %s" % (eval1.times, eval2.times)
-    
-    # How many rows filled out in eval1
-    eval1obs = []
-    for obs in eval1.results.itervalues():
-        eval1obs.extend(obs.values())
-    eval1_count = count_filled_time_intervals(eval1obs)
-    
-    print "Teacher 1: %d time blocks" % eval1_count
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> filename = _write_example(directory)
+    >>> cache = ParseCache(os.path.join(directory, 'my-cache'))
+    >>> observation = TeacherObservation(filename)
+    >>> observation.parse(cache)
+    >>> cached = TeacherObservation(filename)
+    >>> cache.load(cached)
+    True
+    >>> cached.times == observation.times, cached.get_matrix().bits == observation.get_matrix().bits
+    (True, True)
     
-    eval2obs = []
-    for obs in eval2.results.itervalues():
-        eval2obs.extend(obs.values())
-    eval2_count = count_filled_time_intervals(eval2obs)
+    Changing the file makes its entry stale, and the stale entry is removed, but nothing
+    outside of the cache directory is touched
     
-    print "Teacher 2: %d time blocks" % eval2_count
-    
-    if eval1_count>eval2_count:
-        total_time_count = eval1_count
-    else:
-        total_time_count = eval2_count
+    >>> unrelated = _write_example(directory, 'my-notes.obs')
+    >>> filename = _write_example(directory, rows=('0,x,x,x,',))
+    >>> cache.load(TeacherObservation(filename))
+    False
+    >>> TeacherObservation(filename).parse(cache)
+    >>> len(os.listdir(cache.directory)), os.path.exists(unrelated)
+    (1, True)
     
+    An entry which can't be read is a miss, and the cache stays within max_bytes
     
+    >>> with open(cache.entry_path(filename), 'wb') as f:
+    ...     f.write(ParseCache.MAGIC + 'garbage')
+    >>> cache.load(TeacherObservation(filename)), os.listdir(cache.directory)
+    (False, [])
+    >>> small = ParseCache(os.path.join(directory, 'small'), max_bytes=200)
+    >>> for name in ('a.csv', 'b.csv', 'c.csv'):
+    ...     TeacherObservation(_write_example(directory, name)).parse(small)
+    >>> len(os.listdir(small.directory)), small.size <= 200
+    (1, True)
+    >>> ParseCache(small.directory).size == small.size
+    True
+    >>> shutil.rmtree(directory)
+    """
+    MAGIC = 'TOC1'
+    EXTENSION = '.obs'
 
-    # How many rows filled out in eval2
-    
-    # Create a counter to get global statistics
-    cnt = Counter()
-    category_results = defaultdict(list)
-    print "Category results (Observation code, both, neither, first only, second only, overlap %)"
-    for category, observations in eval1.categories.iteritems():
-        eval1_total_counts = sum([sum(observation) for observation in eval1.results[category].itervalues()])
-        eval2_total_counts = sum([sum(observation) for observation in eval2.results[category].itervalues()])
-        
-        print category
-        overlap_counter = 0
-        for observation in observations:
-            
-            eval1results = eval1.results[category][observation]
-            eval2results = eval2.results[category][observation]
-            
-            both_match = sum([1 for index, x in enumerate(eval1results) if x==1 and eval2results[index]==1])
-            neither_match = sum([1 for index, x in enumerate(eval1results) if x==0 and eval2results[index]==0])
-            first_only = sum([1 for index, x in enumerate(eval1results) if x==1 and eval2results[index]==0])
-            second_only = sum([1 for index, x in enumerate(eval1results) if x==0 and eval2results[index]==1])
-            
-            # Increase our global counts
-            cnt['both']+=both_match
-            cnt['neither']+=neither_match
-            cnt['first']+=first_only
-            cnt['second']+=second_only
-            
-            eval1_counts = 100*float(sum(eval1results))/eval1_total_counts
-            eval2_counts = 100*float(sum(eval2results))/eval2_total_counts
-            
-            # We calculate a general agreement for this observation by simply taking the lesser of eval1_counts and eval2_counts
-            if eval1_counts<eval2_counts:
-                overlap = eval1_counts
-            else:
-                overlap = eval2_counts
-            
+    def __init__(self, directory, max_bytes=64*1024*1024, use_hash=False):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.use_hash = use_hash
+        # The directory is only listed once.  After that the entries (path: [last used, size]),
+        # the entries for each file (keyed by the prefix of the entry name) and the total size
+        # are kept up to date as entries are stored, loaded and removed.
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.prefixes = defaultdict(set)
+        self.size = 0
+        for path in glob.glob(os.path.join(directory, '*' + self.EXTENSION)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            self._add(path, stat.st_size, stat.st_mtime)
 
-            overlap_counter+=overlap
-            
-            print " %s, %d, %d, %d, %d, %.1f%%" % (observation, both_match, neither_match, first_only, second_only, overlap)
-            category_results[category].append(both_match)
-        print " Total Overlap for %s: %.1f" % (category, overlap_counter)
-            
+    def _add(self, path, size, used):
+        if path in self.entries:
+            self.size -= self.entries[path][1]
+        self.entries[path] = [used, size]
+        self.prefixes[os.path.basename(path).split('-', 1)[0]].add(path)
+        self.size += size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry[1]
+        self.prefixes[os.path.basename(path).split('-', 1)[0]].discard(path)
+
+    def entry_path(self, filename):
+        """
+        Work out the path of the cache entry for the current version of a file
+        """
+        filename = os.path.abspath(filename)
+        if self.use_hash:
+            with open(filename, 'rb') as f:
+                version = hashlib.sha1(f.read()).hexdigest()
+        else:
+            stat = os.stat(filename)
+            version = hashlib.sha1('%r:%d' % (stat.st_mtime, stat.st_size)).hexdigest()
+        return os.path.join(self.directory, '%s-%s%s' % (hashlib.sha1(filename).hexdigest(), version[:16], self.EXTENSION))
+
+    def remove_stale(self, entry):
+        """
+        Remove any entries for older versions of the same file
+        """
+        with self.lock:
+            for path in list(self.prefixes[os.path.basename(entry).split('-', 1)[0]]):
+                if path != entry:
+                    self._remove(path)
+
+    def load(self, observation):
+        """
+        Fill in a TeacherObservation from the cache.
+        Returns False if there isn't an up to date entry for its file.  An entry which can't be
+        read back (say a disk filled up while it was written) is removed and counts as missing.
+        """
+        entry = self.entry_path(observation.filename)
+        with timed_stage('cache_load') as record:
+            try:
+                with open(entry, 'rb') as f:
+                    data = f.read()
+            except IOError:
+                self.remove_stale(entry)
+                return False
+            record['bytes_read'] = len(data)
+            try:
+                if not data.startswith(self.MAGIC):
+                    raise ValueError("Not a cache entry")
+                categories, times, rows, packed = marshal.loads(data[len(self.MAGIC):])
+                categories = OrderedDict(categories)
+                matrix = ObservationMatrix.from_bytes(categories, rows, packed)
+            except (EOFError, ValueError, TypeError):
+                with self.lock:
+                    self._remove(entry)
+                return False
+            observation.load_matrix(categories, times, matrix)
+            record['rows'] = rows
+        # Mark the entry as recently used
+        with self.lock:
+            self._add(entry, len(data), time.time())
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return True
+
+    def store(self, observation):
+        """
+        Save a parsed TeacherObservation, then evict old entries if the cache is too big
+        """
+        entry = self.entry_path(observation.filename)
+        matrix = observation.get_matrix()
+        data = self.MAGIC + marshal.dumps((observation.categories.items(), observation.times,
+                                           matrix.rows, matrix.to_bytes()))
+        # Write to a temporary file first, so a reader never sees half an entry
+        temporary = '%s.%d.%d.tmp' % (entry, os.getpid(), threading.current_thread().ident)
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.rename(temporary, entry)
+        with self.lock:
+            self._add(entry, len(data), time.time())
+        self.remove_stale(entry)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        """
+        with self.lock:
+            for used, path in sorted((entry[0], path) for path, entry in self.entries.iteritems()):
+                if self.size <= self.max_bytes:
+                    break
+                self._remove(path)
 
-    print """Totals:
-Both: %d
-Neither: %d
-First only: %d
-Second only: %d
-Total: %d
-Total agreement: %d (%.2f%%)
-""" % (cnt['both'], cnt['neither'], cnt['first'], cnt['second'], \
-                           sum(cnt.values()), cnt['both']+cnt['neither'], \
-                           100.0*(cnt['both']+cnt['neither'])/sum(cnt.values()))
-    return cnt, category_results, total_time_count
-    
 
-def html_output(eval1, eval2, output_file, category_result, time_blocks):
+def write_corpus_archive(path, observations):
     """
-    A quick and dirty attempt at making some plots
+    Write a list of parsed observations into a single columnar archive, which can be opened
+    with CorpusArchive.
+    
+    The layout (all little endian) is:
+    
+        header          magic, session count, column count, section offsets
+        dictionary      the (category, observation) columns shared by every session, in marshal format
+        session table   one fixed size record per session: matrix byte offset, rows, and the
+                        offsets of its name, times and column list in the string section
+        strings         names, newline separated times and arrays of dictionary indexes
+        matrix          one contiguous bit matrix.  Each dictionary column is stored as a run of
+                        bytes covering every session, and each session starts on a byte boundary
+    
+    so one session or one code column can be read without reading the rest of the file.
     """
-    import json
+    dictionary = []
+    dictionary_index = {}
+    strings = []
+    strings_length = 0
+    sessions = []
+    byte_start = 0
+    for observation in observations:
+        matrix = observation.get_matrix()
+        column_map = []
+        for column in matrix.columns:
+            if column not in dictionary_index:
+                dictionary_index[column] = len(dictionary)
+                dictionary.append(column)
+            column_map.append(dictionary_index[column])
+        record = [byte_start, matrix.rows]
+        for value in (observation.filename, '\n'.join(observation.times),
+                      struct.pack('<%dI' % len(column_map), *column_map)):
+            record.extend([strings_length, len(value)])
+            strings.append(value)
+            strings_length += len(value)
+        sessions.append((record, matrix, dict((index, position) for position, index in enumerate(column_map))))
+        byte_start += matrix.row_bytes
     
-    def tree():
-        return defaultdict(tree)
+    dictionary_data = marshal.dumps(dictionary)
+    dictionary_offset = CorpusArchive.HEADER.size
+    sessions_offset = dictionary_offset + len(dictionary_data)
+    strings_offset = sessions_offset + len(sessions) * CorpusArchive.SESSION.size
+    matrix_offset = strings_offset + strings_length
     
-    def get_title(category, observation):
-       return "%s: %s" % (category, observation)  
+    with open(path, 'wb') as f:
+        f.write(CorpusArchive.HEADER.pack(CorpusArchive.MAGIC, len(sessions), len(dictionary), byte_start,
+                                          dictionary_offset, len(dictionary_data), sessions_offset,
+                                          strings_offset, matrix_offset))
+        f.write(dictionary_data)
+        for record, matrix, positions in sessions:
+            f.write(CorpusArchive.SESSION.pack(*record))
+        for value in strings:
+            f.write(value)
+        # Write the matrix one dictionary column at a time
+        for dictionary_column in xrange(len(dictionary)):
+            for record, matrix, positions in sessions:
+                width = matrix.row_bytes
+                if dictionary_column in positions:
+                    value = matrix.bits[positions[dictionary_column]]
+                    f.write(ObservationMatrix.column_bytes(value, width))
+                else:
+                    f.write('\0' * width)
+
+
+class CorpusArchive(object):
+    """
+    Read access to an archive written by write_corpus_archive.
     
-    def get_css_name(name):
-        return name.translate(None, r"""!"#$%&'()*+,./:;<=>?@[\]^`{|}~ 0123456789""")
+    The file is memory mapped and only the header and the column dictionary are read up front,
+    so opening an archive is quick no matter how many sessions it holds.  Sessions and code
+    columns are read out of the map when they are asked for.
     
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> observations = []
+    >>> for name, rows in [('first.csv', ('0,x,,x,', '2,,x,,')), ('second.csv', ['%d,x,,,' % (2*row) for row in range(10)])]:
+    ...     observation = TeacherObservation(_write_example(directory, name, rows))
+    ...     observation.parse()
+    ...     observations.append(observation)
+    >>> write_corpus_archive(os.path.join(directory, 'corpus.toa'), observations)
+    >>> with CorpusArchive(os.path.join(directory, 'corpus.toa')) as archive:
+    ...     sessions = list(archive)
+    ...     lecture = archive.code_column('1. Instructor', 'Lec')
+    >>> [(session.times, session.categories, session.get_matrix().bits) for session in sessions] == \\
+    ...     [(observation.times, observation.categories, observation.get_matrix().bits) for observation in observations]
+    True
+    >>> lecture == [0b01, 0b1111111111]
+    True
+    >>> shutil.rmtree(directory)
+    """
+    MAGIC = 'TOARCH01'
+    HEADER = struct.Struct('<8sIIQQQQQQ')
+    SESSION = struct.Struct('<QIQIQIQI')
 
-    head="""<!DOCTYPE html>
-<html>
-  <head>
-    <title>
-        %s
-    </title>
-    <style>
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.session_count, column_count, self.column_bytes, dictionary_offset, dictionary_length,
+         self.sessions_offset, self.strings_offset, self.matrix_offset) = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            raise IOError("%s is not an observation archive" % path)
+        self.columns = [tuple(column) for column in
+                        marshal.loads(self.map[dictionary_offset:dictionary_offset + dictionary_length])]
+        self.column_index = dict((column, index) for index, column in enumerate(self.columns))
+
+    @classmethod
+    def is_archive(cls, path):
+        """
+        Check whether a file is an observation archive
+        """
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.session_count
+
+    def _record(self, index):
+        if not 0 <= index < self.session_count:
+            raise IndexError("There is no session %d in %s" % (index, self.path))
+        return self.SESSION.unpack_from(self.map, self.sessions_offset + index * self.SESSION.size)
+
+    def _string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.map[start:start + length]
+
+    def session_name(self, index):
+        """
+        The file name a session was parsed from
+        """
+        record = self._record(index)
+        return self._string(record[2], record[3])
+
+    def _session_bits(self, byte_start, rows, dictionary_column):
+        start = self.matrix_offset + dictionary_column * self.column_bytes + byte_start
+        return ObservationMatrix.bytes_column(self.map[start:start + (rows + 7) // 8])
+
+    def session(self, index, compact=True):
+        """
+        Read one session back out as a TeacherObservation
+        """
+        (byte_start, rows, name_offset, name_length, times_offset, times_length,
+         columns_offset, columns_length) = self._record(index)
+        column_map = struct.unpack('<%dI' % (columns_length // 4), self._string(columns_offset, columns_length))
+        categories = OrderedDict()
+        for dictionary_column in column_map:
+            category, observation = self.columns[dictionary_column]
+            categories.setdefault(category, []).append(observation)
+        times = self._string(times_offset, times_length).split('\n') if rows else []
+        matrix = ObservationMatrix(categories)
+        matrix.rows = rows
+        matrix.bits = [self._session_bits(byte_start, rows, dictionary_column) for dictionary_column in column_map]
+        return TeacherObservation.from_matrix(self._string(name_offset, name_length), categories, times, matrix, compact)
+
+    def __iter__(self):
+        for index in xrange(self.session_count):
+            yield self.session(index)
+
+    def code_column(self, category, observation):
+        """
+        Read one code across every session, as a list with a bitmask of the marked time blocks
+        for each session (0 for sessions which don't have this code)
+        """
+        dictionary_column = self.column_index[(category, observation)]
+        column = []
+        for index in xrange(self.session_count):
+            record = self._record(index)
+            column.append(self._session_bits(record[0], record[1], dictionary_column))
+        return column
+
+
+def time_value(time):
+    """
+    Turn a time block's start time into a number, or None if it isn't one
+
+    >>> time_value('12'), time_value('MIN')
+    (12.0, None)
+    """
+    try:
+        return float(time)
+    except ValueError:
+        return None
+
+
+def resolve_code(columns, code, category=None):
+    """
+    Find the (category, observation) column for a code out of the columns known.  Codes like
+    O and L appear in more than one category, so those need the category too.
+    
+    >>> columns = [('1. instructor', 'O'), ('2. Students', 'O'), ('2. Students', 'CG')]
+    >>> resolve_code(columns, 'CG'), resolve_code(columns, 'O', '2. Students')
+    (('2. Students', 'CG'), ('2. Students', 'O'))
+    """
+    if isinstance(code, tuple):
+        return code
+    matches = [column for column in columns if column[1].strip() == code.strip()
+               and (category is None or column[0] == category)]
+    if len(matches) > 1:
+        raise ValueError("%s is in more than one category (%s), pass the category too"
+                         % (code, ', '.join(sorted(column[0] for column in matches))))
+    return matches[0] if matches else (category, code)
+
+
+class CodeQueries(object):
+    """
+    The questions CorpusIndex and ObservationStore can both answer about a corpus.  Sessions are
+    picked out by their metadata, and start and end limit the time blocks to those starting at or
+    after start and before end.  A code can be given on its own, or with its category if it is in
+    more than one (see resolve_code).
+    
+    Subclasses provide select, code_counts, sessions_with and time_series.
+    """
+    def select(self, since=None, until=None, **metadata):
+        """
+        The ids of the sessions whose metadata matches every keyword given.
+        since and until limit the date metadata (inclusive), comparing them as strings, so
+        dates should be written like 2013-09-04.
+        """
+        raise NotImplementedError
+
+    def code_counts(self, code, category=None, start=None, end=None, **metadata):
+        """
+        Count the time blocks marked with a code and the total time blocks over the selected sessions.
+        Returns (marked, total).
+        """
+        raise NotImplementedError
+
+    def code_fraction(self, code, category=None, start=None, end=None, **metadata):
+        """
+        The fraction of the selected sessions' time blocks which were marked with a code,
+        or None if no time blocks were selected
+        """
+        marked, total = self.code_counts(code, category, start, end, **metadata)
+        if total == 0:
+            return None
+        return float(marked)/total
+
+    def sessions_with(self, code, category=None, start=None, end=None, **metadata):
+        """
+        The ids of the selected sessions where a code was marked in any time block between start and end
+        """
+        raise NotImplementedError
+
+    def time_series(self, code, category=None, order_by='date', **metadata):
+        """
+        The fraction of time blocks marked with a code in each selected session, as a list of
+        (session metadata, fraction) ordered by one of the metadata fields
+        """
+        raise NotImplementedError
+
+
+class CorpusIndex(CodeQueries):
+    """
+    An index over many parsed observations, so questions about a whole corpus can be answered
+    without going back to the csv files.
+    
+    For each code there is a posting dict mapping session ids to the bitmask of time blocks the
+    code was marked in (sessions which never used the code are left out), and each session keeps
+    its metadata, such as teacher, observer or date, and the start time of each time block.
+    Sessions can be added at any time.
+    
+        index = CorpusIndex()
+        index.add(observation, teacher='X', date='2013-09-04')
+        index.code_fraction('Lec', teacher='X', since='2013-09-01')
+        index.sessions_with('CG', end=10)
+    
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> def parsed(*args):
+    ...     observation = TeacherObservation(_write_example(directory, *args))
+    ...     observation.parse()
+    ...     return observation
+    >>> index = CorpusIndex()
+    >>> index.add(parsed('first.csv'), teacher='X', date='2013-09-04')
+    0
+    >>> index.add(parsed('second.csv', ('0,x,,x,,,', '2,x,,,,x,', '4,,,,,,', '6,,x,,,,'),
+    ...                  (',1. Instructor,,,2. Students,,Comments', 'MIN,Lec,CQ,O,L,O,')), teacher='Y', date='2013-10-01')
+    1
+    >>> index.code_counts('Lec'), index.code_counts('Lec', until='2013-09-30'), index.code_fraction('Lec', since='2013-09-10')
+    ((4, 7), (2, 3), 0.5)
+    >>> index.sessions_with('CQ', end=3), index.sessions_with('CQ', start=5)
+    ([0], [1])
+    >>> [(metadata['teacher'], round(fraction, 3)) for metadata, fraction in index.time_series('Lec')]
+    [('X', 0.667), ('Y', 0.5)]
+    
+    O is a code in both categories of the second session, so it needs its category
+    
+    >>> index.code_counts('O')
+    Traceback (most recent call last):
+    ValueError: O is in more than one category (1. Instructor, 2. Students), pass the category too
+    >>> index.code_counts('O', '2. Students')
+    (1, 7)
+    
+    Adding a file again replaces it, and the index can be saved and loaded
+    
+    >>> index.add(parsed('first.csv', ('0,,,x,',)), teacher='X', date='2013-09-04')
+    0
+    >>> len(index.sessions), index.code_counts('Lec')
+    (2, (2, 5))
+    >>> index.save(os.path.join(directory, 'corpus.index'))
+    >>> loaded = CorpusIndex.load(os.path.join(directory, 'corpus.index'))
+    >>> loaded.sessions == index.sessions, loaded.code_counts('Lec'), loaded.sessions_with('L')
+    (True, (2, 5), [0])
+    >>> shutil.rmtree(directory)
+    """
+    def __init__(self):
+        self.sessions = []
+        self.times = []
+        self.rows = []
+        self.postings = defaultdict(dict)
+        self.filenames = {}
+
+    def add(self, observation, **metadata):
+        """
+        Add a parsed observation, with any metadata to query it by, and return its session id.
+        Adding a file which is already in the index replaces it.
+        """
+        matrix = observation.get_matrix()
+        metadata['filename'] = observation.filename
+        session = self.filenames.get(observation.filename)
+        if session is None:
+            session = len(self.sessions)
+            self.sessions.append(metadata)
+            self.times.append(None)
+            self.rows.append(0)
+            self.filenames[observation.filename] = session
+        else:
+            self.sessions[session] = metadata
+            for posting in self.postings.itervalues():
+                posting.pop(session, None)
+        self.times[session] = [time_value(time) for time in observation.times]
+        self.rows[session] = matrix.rows
+        for column, bits in zip(matrix.columns, matrix.bits):
+            if bits:
+                self.postings[column][session] = bits
+        return session
+
+    def resolve(self, code, category=None):
+        """
+        Find the (category, observation) column for a code, see resolve_code
+        """
+        return resolve_code(self.postings, code, category)
+
+    def select(self, since=None, until=None, **metadata):
+        """
+        See CodeQueries.select, checking each session's metadata in turn
+        """
+        selected = []
+        for session, session_metadata in enumerate(self.sessions):
+            if any(session_metadata.get(key) != value for key, value in metadata.iteritems()):
+                continue
+            date = session_metadata.get('date')
+            if since is not None and (date is None or date < since):
+                continue
+            if until is not None and (date is None or date > until):
+                continue
+            selected.append(session)
+        return selected
+
+    def time_mask(self, session, start=None, end=None):
+        """
+        The bitmask of a session's time blocks which start at or after start and before end
+        """
+        mask = 0
+        for row, time in enumerate(self.times[session]):
+            if time is None:
+                continue
+            if (start is None or time >= start) and (end is None or time < end):
+                mask |= 1 << row
+        return mask
+
+    def code_counts(self, code, category=None, start=None, end=None, **metadata):
+        """
+        See CodeQueries.code_counts.  Each session's posting is masked down to the time blocks
+        between start and end before it is counted.
+        """
+        posting = self.postings.get(self.resolve(code, category), {})
+        marked = 0
+        total = 0
+        for session in self.select(**metadata):
+            if start is None and end is None:
+                mask = (1 << self.rows[session]) - 1
+            else:
+                mask = self.time_mask(session, start, end)
+            marked += popcount(posting.get(session, 0) & mask)
+            total += popcount(mask)
+        return marked, total
+
+    def sessions_with(self, code, category=None, start=None, end=None, **metadata):
+        """
+        See CodeQueries.sessions_with.  Sessions missing from the code's posting are skipped
+        without building their time mask.
+        """
+        posting = self.postings.get(self.resolve(code, category), {})
+        found = []
+        for session in self.select(**metadata):
+            bits = posting.get(session, 0)
+            if bits and (start is None and end is None or bits & self.time_mask(session, start, end)):
+                found.append(session)
+        return found
+
+    def time_series(self, code, category=None, order_by='date', **metadata):
+        """
+        See CodeQueries.time_series, sorting the sessions once their fractions are worked out
+        """
+        column = self.resolve(code, category)
+        posting = self.postings.get(column, {})
+        series = []
+        for session in self.select(**metadata):
+            rows = self.rows[session]
+            fraction = float(popcount(posting.get(session, 0)))/rows if rows else None
+            series.append((self.sessions[session], fraction))
+        series.sort(key=lambda item: item[0].get(order_by))
+        return series
+
+    def save(self, path):
+        """
+        Save the index, so it can be loaded and added to later
+        """
+        with open(path, 'wb') as f:
+            marshal.dump((self.sessions, self.times, self.rows, dict(self.postings)), f)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, 'rb') as f:
+            index.sessions, index.times, index.rows, postings = marshal.load(f)
+        index.postings.update(postings)
+        index.filenames = dict((metadata['filename'], session) for session, metadata in enumerate(index.sessions))
+        return index
+
+
+class ObservationStore(CodeQueries):
+    """
+    Parsed observations kept in a SQLite database, for queries over years of sessions without
+    going back to the csv files.
+    
+    Each file is stored once, keyed by the sha1 of its contents, along with its session, observer,
+    teacher and date.  Its codes (in spreadsheet order), the time of each time block and every
+    marked (time block, code) cell go in their own tables, indexed so the same questions as
+    CorpusIndex can be answered in SQL.  Ingesting a file which is already stored does nothing,
+    and ingesting a changed file replaces the old version.
+    
+        store = ObservationStore('observations.db')
+        store.ingest_many(observations, observer='A')
+        store.code_fraction('Lec', observer='A', since='2013-09-01')
+    
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> observation = TeacherObservation(_write_example(directory))
+    >>> observation.parse()
+    >>> store = ObservationStore(os.path.join(directory, 'observations.db'))
+    >>> store.ingest(observation, observer='A'), store.ingest(observation, observer='A')
+    (1, 1)
+    >>> stored = store.load(1)
+    >>> stored.categories == observation.categories, stored.times == observation.times
+    (True, True)
+    >>> stored.get_matrix().bits == observation.get_matrix().bits
+    True
+    >>> store.code_counts('Lec'), store.sessions_with('CQ', start=4), store.select(observer='B')
+    ((2, 3), [1], [])
+    
+    A changed file replaces the old version
+    
+    >>> observation = TeacherObservation(_write_example(directory, rows=('0,x,,,',)))
+    >>> observation.parse()
+    >>> store.ingest(observation, observer='A') in store.select(), len(store.select()), store.code_counts('Lec')
+    (True, 1, (1, 1))
+    >>> store.close()
+    >>> shutil.rmtree(directory)
+    """
+    METADATA = ('session', 'observer', 'teacher', 'date')
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            sha1 TEXT NOT NULL UNIQUE,
+            filename TEXT NOT NULL,
+            session TEXT,
+            observer TEXT,
+            teacher TEXT,
+            date TEXT,
+            time_blocks INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS codes (
+            id INTEGER PRIMARY KEY,
+            category TEXT NOT NULL,
+            observation TEXT NOT NULL,
+            UNIQUE (category, observation)
+        );
+        CREATE TABLE IF NOT EXISTS columns (
+            file_id INTEGER NOT NULL REFERENCES files(id),
+            position INTEGER NOT NULL,
+            code_id INTEGER NOT NULL REFERENCES codes(id),
+            PRIMARY KEY (file_id, position)
+        );
+        CREATE TABLE IF NOT EXISTS blocks (
+            file_id INTEGER NOT NULL REFERENCES files(id),
+            row INTEGER NOT NULL,
+            time TEXT,
+            start REAL,
+            PRIMARY KEY (file_id, row)
+        );
+        CREATE TABLE IF NOT EXISTS hits (
+            file_id INTEGER NOT NULL REFERENCES files(id),
+            row INTEGER NOT NULL,
+            code_id INTEGER NOT NULL REFERENCES codes(id),
+            PRIMARY KEY (file_id, code_id, row)
+        );
+        CREATE INDEX IF NOT EXISTS files_session ON files(session);
+        CREATE INDEX IF NOT EXISTS files_observer ON files(observer);
+        CREATE INDEX IF NOT EXISTS files_date ON files(date);
+        CREATE INDEX IF NOT EXISTS files_filename ON files(filename);
+        CREATE INDEX IF NOT EXISTS hits_code ON hits(code_id, file_id);
+    """
+    
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(self.SCHEMA)
+        self.connection.commit()
+        self.code_ids = dict(((category, observation), code_id) for code_id, category, observation
+                             in self.connection.execute('SELECT id, category, observation FROM codes'))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        self.connection.close()
+    
+    @staticmethod
+    def file_hash(filename):
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    
+    def code_id(self, column):
+        code_id = self.code_ids.get(column)
+        if code_id is None:
+            code_id = self.connection.execute('INSERT INTO codes (category, observation) VALUES (?, ?)', column).lastrowid
+            self.code_ids[column] = code_id
+        return code_id
+    
+    def _delete(self, file_ids):
+        rows = [(file_id,) for file_id in file_ids]
+        for table in ('hits', 'blocks', 'columns'):
+            self.connection.executemany('DELETE FROM %s WHERE file_id = ?' % table, rows)
+        self.connection.executemany('DELETE FROM files WHERE id = ?', rows)
+    
+    def ingest_many(self, observations, **metadata):
+        """
+        Store a sequence of parsed observations in a single transaction, with any of the METADATA
+        fields.  session defaults to the file's name without its extension.
+        Returns the file id of each observation; files which were already stored keep their id.
+        """
+        unknown = set(metadata) - set(self.METADATA)
+        if unknown:
+            raise ValueError("Unknown metadata %s, the store keeps %s" % (', '.join(sorted(unknown)), ', '.join(self.METADATA)))
+        file_ids = []
+        with self.connection:
+            cursor = self.connection.cursor()
+            for observation in observations:
+                sha1 = self.file_hash(observation.filename)
+                row = cursor.execute('SELECT id FROM files WHERE sha1 = ?', (sha1,)).fetchone()
+                if row is not None:
+                    file_ids.append(row[0])
+                    continue
+                # A file which has changed since it was stored replaces the old version
+                self._delete([file_id for file_id, in cursor.execute('SELECT id FROM files WHERE filename = ?',
+                                                                     (observation.filename,))])
+                fields = dict(metadata)
+                fields.setdefault('session', os.path.splitext(os.path.basename(observation.filename))[0])
+                matrix = observation.get_matrix()
+                cursor.execute('INSERT INTO files (sha1, filename, session, observer, teacher, date, time_blocks) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (sha1, observation.filename) + tuple(fields.get(name) for name in self.METADATA) + (matrix.rows,))
+                file_id = cursor.lastrowid
+                code_ids = [self.code_id(column) for column in matrix.columns]
+                cursor.executemany('INSERT INTO columns (file_id, position, code_id) VALUES (?, ?, ?)',
+                                   [(file_id, position, code_id) for position, code_id in enumerate(code_ids)])
+                cursor.executemany('INSERT INTO blocks (file_id, row, time, start) VALUES (?, ?, ?, ?)',
+                                   [(file_id, row, time, time_value(time)) for row, time in enumerate(observation.times)])
+                cursor.executemany('INSERT INTO hits (file_id, row, code_id) VALUES (?, ?, ?)',
+                                   self._hits(file_id, code_ids, matrix.bits))
+                file_ids.append(file_id)
+        return file_ids
+    
+    @staticmethod
+    def _hits(file_id, code_ids, bits):
+        for code_id, value in zip(code_ids, bits):
+            for row in set_bits(value):
+                yield file_id, row, code_id
+    
+    def ingest(self, observation, **metadata):
+        """
+        Store one parsed observation and return its file id
+        """
+        return self.ingest_many([observation], **metadata)[0]
+    
+    def load(self, file_id, compact=True):
+        """
+        Read a stored observation back as a TeacherObservation
+        """
+        filename, rows = self.connection.execute('SELECT filename, time_blocks FROM files WHERE id = ?', (file_id,)).fetchone()
+        categories = OrderedDict()
+        for category, observation in self.connection.execute(
+                'SELECT category, observation FROM columns JOIN codes ON codes.id = columns.code_id '
+                'WHERE file_id = ? ORDER BY position', (file_id,)):
+            categories.setdefault(category, []).append(observation)
+        times = [time for time, in self.connection.execute('SELECT time FROM blocks WHERE file_id = ? ORDER BY row', (file_id,))]
+        matrix = ObservationMatrix(categories)
+        matrix.rows = rows
+        for category, observation, row in self.connection.execute(
+                'SELECT category, observation, row FROM hits JOIN codes ON codes.id = hits.code_id '
+                'WHERE file_id = ?', (file_id,)):
+            matrix.bits[matrix.column_index[(category, observation)]] |= 1 << row
+        return TeacherObservation.from_matrix(filename, categories, times, matrix, compact)
+    
+    def _where(self, since=None, until=None, **metadata):
+        """
+        The WHERE clause and parameters selecting files by metadata, like CorpusIndex.select
+        """
+        clauses = ['1']
+        parameters = []
+        for name, value in sorted(metadata.iteritems()):
+            if name not in self.METADATA + ('filename',):
+                raise ValueError("Unknown metadata %s" % name)
+            clauses.append('files.%s = ?' % name)
+            parameters.append(value)
+        if since is not None:
+            clauses.append('files.date >= ?')
+            parameters.append(since)
+        if until is not None:
+            clauses.append('files.date <= ?')
+            parameters.append(until)
+        return ' AND '.join(clauses), parameters
+    
+    def select(self, since=None, until=None, **metadata):
+        """
+        See CodeQueries.select, where each session is a stored file
+        """
+        where, parameters = self._where(since, until, **metadata)
+        return [file_id for file_id, in self.connection.execute('SELECT id FROM files WHERE %s ORDER BY id' % where, parameters)]
+    
+    def resolve(self, code, category=None):
+        """
+        Find the (category, observation) column for a code, see resolve_code
+        """
+        return resolve_code(self.code_ids, code, category)
+    
+    def _time_clause(self, table, start, end):
+        clauses = []
+        parameters = []
+        if start is not None:
+            clauses.append(' AND %s.start >= ?' % table)
+            parameters.append(start)
+        if end is not None:
+            clauses.append(' AND %s.start < ?' % table)
+            parameters.append(end)
+        return ''.join(clauses), parameters
+    
+    def code_counts(self, code, category=None, start=None, end=None, **metadata):
+        """
+        See CodeQueries.code_counts.  Without start or end the totals come straight from the
+        files table, otherwise the hits are joined to the blocks to check their times.
+        """
+        code_id = self.code_ids.get(self.resolve(code, category))
+        where, parameters = self._where(**metadata)
+        if start is None and end is None:
+            total, = self.connection.execute('SELECT COALESCE(SUM(time_blocks), 0) FROM files WHERE %s' % where,
+                                             parameters).fetchone()
+            marked, = self.connection.execute('SELECT COUNT(*) FROM hits JOIN files ON files.id = hits.file_id '
+                                              'WHERE hits.code_id = ? AND %s' % where, [code_id] + parameters).fetchone()
+            return marked, total
+        times, time_parameters = self._time_clause('blocks', start, end)
+        total, = self.connection.execute('SELECT COUNT(*) FROM blocks JOIN files ON files.id = blocks.file_id '
+                                         'WHERE %s%s' % (where, times), parameters + time_parameters).fetchone()
+        marked, = self.connection.execute(
+            'SELECT COUNT(*) FROM hits JOIN files ON files.id = hits.file_id '
+            'JOIN blocks ON blocks.file_id = hits.file_id AND blocks.row = hits.row '
+            'WHERE hits.code_id = ? AND %s%s' % (where, times), [code_id] + parameters + time_parameters).fetchone()
+        return marked, total
+    
+    def sessions_with(self, code, category=None, start=None, end=None, **metadata):
+        """
+        See CodeQueries.sessions_with, answered with a single query over the hits
+        """
+        code_id = self.code_ids.get(self.resolve(code, category))
+        where, parameters = self._where(**metadata)
+        times, time_parameters = self._time_clause('blocks', start, end)
+        return [file_id for file_id, in self.connection.execute(
+            'SELECT DISTINCT files.id FROM hits JOIN files ON files.id = hits.file_id '
+            'JOIN blocks ON blocks.file_id = hits.file_id AND blocks.row = hits.row '
+            'WHERE hits.code_id = ? AND %s%s ORDER BY files.id' % (where, times),
+            [code_id] + parameters + time_parameters)]
+    
+    def time_series(self, code, category=None, order_by='date', **metadata):
+        """
+        See CodeQueries.time_series.  order_by has to be one of the stored metadata fields,
+        since it goes into the ORDER BY clause.
+        """
+        if order_by not in self.METADATA + ('filename',):
+            raise ValueError("Can't order by %s" % order_by)
+        code_id = self.code_ids.get(self.resolve(code, category))
+        where, parameters = self._where(**metadata)
+        series = []
+        for row in self.connection.execute(
+                'SELECT files.filename, files.session, files.observer, files.teacher, files.date, files.time_blocks, '
+                '(SELECT COUNT(*) FROM hits WHERE hits.file_id = files.id AND hits.code_id = ?) '
+                'FROM files WHERE %s ORDER BY files.%s, files.id' % (where, order_by), [code_id] + parameters):
+            metadata = dict(zip(('filename',) + self.METADATA, row[:5]))
+            series.append((metadata, float(row[6])/row[5] if row[5] else None))
+        return series
+
+
+TimeBlock = namedtuple('TimeBlock', ['time', 'codes'])
+
+
+class RunningTotals(object):
+    """
+    Aggregates which are kept up to date as time blocks are streamed in, so they can be read
+    at any point while the file is still being read
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        self.time_blocks = 0
+        self.filled_time_intervals = 0
+        self.code_counts = [0] * len(columns)
+
+    def update(self, block):
+        self.time_blocks += 1
+        codes = block.codes
+        if codes:
+            self.filled_time_intervals += 1
+        code_counts = self.code_counts
+        for index in set_bits(codes):
+            code_counts[index] += 1
+
+    def counts_by_code(self):
+        """
+        The per-code totals so far, as an OrderedDict keyed by (category, observation)
+        """
+        return OrderedDict(zip(self.columns, self.code_counts))
+
+
+class ObservationStream(object):
+    """
+    Read an observation one time block at a time, without keeping any of it in memory.
+    
+    The header is read straight away, so categories and columns are available before iterating.
+    Iterating gives a TimeBlock for each row, where codes is a bitmask of the active columns
+    (bit i set means columns[i] was marked).  totals is updated before each block is handed out.
+    
+    Any open file will do, so observations can be piped in from other tools:
+    
+        stream = ObservationStream(sys.stdin)
+        for block in stream:
+            print block.time, stream.totals.filled_time_intervals
+    
+    >>> stream = ObservationStream(StringIO('Observer: example\\n,1. Instructor,,2. Students,Comments\\n'
+    ...                                     'MIN,Lec,CQ,L,\\n0,x,,x,\\n2,,,,\\n4,x,x,,ok\\n'))
+    >>> stream.columns
+    [('1. Instructor', 'Lec'), ('1. Instructor', 'CQ'), ('2. Students', 'L')]
+    >>> for block in stream:
+    ...     print block.time, stream.active_codes(block), stream.totals.time_blocks, stream.totals.filled_time_intervals
+    0 [('1. Instructor', 'Lec'), ('2. Students', 'L')] 1 1
+    2 [] 2 1
+    4 [('1. Instructor', 'Lec'), ('1. Instructor', 'CQ')] 3 2
+    >>> stream.totals.counts_by_code().values()
+    [2, 1, 1]
+    """
+    def __init__(self, csvfile):
+        self.reader, self.schema = TeacherObservation.read_header(csvfile)
+        self.categories = self.schema.copy_categories()
+        self.columns = self.schema.columns
+        self.totals = RunningTotals(self.columns)
+
+    def active_codes(self, block):
+        """
+        The (category, observation) columns which were marked in a time block
+        """
+        return [column for index, column in enumerate(self.columns) if block.codes >> index & 1]
+
+    def __iter__(self):
+        decode = self.schema.decode
+        for time_block, line in TeacherObservation.read_rows(self.reader):
+            block = TimeBlock(time_block, decode(line))
+            self.totals.update(block)
+            yield block
+
+
+def count_filled_time_intervals(observations):
+    """
+    We want to count how many time intervals were actually filled out - that means 
+    that it is non-zero for any observation 
+    """
+    # Put all the observations together:
+    obs = zip(*observations)
+    
+    # Count up the intervals that have anything filled out
+    return sum([1 for x in obs if any(x) is True])
+    
+    
+def contingency_tables(matrix1, matrix2, counts1=None, counts2=None):
+    """
+    Compute the 2x2 contingency table for every code of two ObservationMatrix objects in one pass.
+    Each column is compared with a single AND of the two bitmasks, and the rest of the table
+    falls out of the popcounts:
+    
+        both = |a & b|, first only = |a| - both, second only = |b| - both, neither = rows - the rest
+    
+    Returns a tuple of (tables, category_totals, totals).  tables is an OrderedDict mapping each
+    (category, observation) column to a (both, neither, first, second) tuple, category_totals maps
+    each broad category to a Counter with the same keys, and totals is a Counter of everything.
+    
+    counts1 and counts2 can be the already known number of marks in each column (such as
+    TeacherObservation.code_counts), to save counting them again.
+    
+    >>> categories = OrderedDict([('1. Instructor', ['Lec', 'CQ']), ('2. Students', ['L'])])
+    >>> matrix1, matrix2 = ObservationMatrix(categories), ObservationMatrix(categories)
+    >>> for marked1, marked2 in [([0, 2], [0]), ([0], [1]), ([1], [1, 2]), ([], [])]:
+    ...     matrix1.append_marked(marked1); matrix2.append_marked(marked2)
+    >>> tables, category_totals, totals = contingency_tables(matrix1, matrix2)
+    >>> tables.items()
+    [(('1. Instructor', 'Lec'), (1, 2, 1, 0)), (('1. Instructor', 'CQ'), (1, 2, 0, 1)), (('2. Students', 'L'), (0, 2, 1, 1))]
+    >>> sorted(category_totals['1. Instructor'].items()), sorted(category_totals['2. Students'].items())
+    ([('both', 2), ('first', 1), ('neither', 4), ('second', 1)], [('both', 0), ('first', 1), ('neither', 2), ('second', 1)])
+    >>> sorted(totals.items())
+    [('both', 2), ('first', 2), ('neither', 6), ('second', 2)]
+    """
+    assert matrix1.columns == matrix2.columns, "The columns do not match, I can't compare these"
+    assert matrix1.rows == matrix2.rows, "The number of time blocks does not match, I can't compare these"
+    rows = matrix1.rows
+    if counts1 is None:
+        counts1 = [popcount(bits) for bits in matrix1.bits]
+    if counts2 is None:
+        counts2 = [popcount(bits) for bits in matrix2.bits]
+    tables = OrderedDict()
+    category_totals = defaultdict(Counter)
+    totals = Counter()
+    for (category, observation), first_bits, second_bits, first_count, second_count in \
+            zip(matrix1.columns, matrix1.bits, matrix2.bits, counts1, counts2):
+        both = popcount(first_bits & second_bits)
+        first = first_count - both
+        second = second_count - both
+        neither = rows - both - first - second
+        tables[(category, observation)] = (both, neither, first, second)
+        category_total = category_totals[category]
+        category_total['both'] += both
+        category_total['neither'] += neither
+        category_total['first'] += first
+        category_total['second'] += second
+    for category_total in category_totals.itervalues():
+        totals.update(category_total)
+    return tables, category_totals, totals
+
+
+AlignmentCoverage = namedtuple('AlignmentCoverage', ['compared', 'first_discarded', 'second_discarded',
+                                                     'first_filled', 'second_filled'])
+
+
+def align_time_blocks(times1, times2, fill_gaps=False):
+    """
+    Merge-join two sequences of time block start times, in linear time.
+    
+    Returns a list of (time, first row, second row) for the time blocks which will be compared.
+    Without fill_gaps only the times both observations have are kept.  With fill_gaps every
+    time from either observation is kept, and the missing row is None.  Times are matched by
+    their numeric value if they have one.  If a sequence isn't in order it gets sorted first.
+    
+    >>> align_time_blocks(['0', '2', '4', '6'], ['2', '4', '6', '8'])
+    [('2', 1, 0), ('4', 2, 1), ('6', 3, 2)]
+    >>> align_time_blocks(['0', '2'], ['2', '4'], fill_gaps=True)
+    [('0', 0, None), ('2', 1, 0), ('4', None, 1)]
+    """
+    def ordered(times):
+        keyed = [(time_value(time), time, row) for row, time in enumerate(times)]
+        keyed = [(time if value is None else value, time, row) for value, time, row in keyed]
+        if any(keyed[index][0] > keyed[index + 1][0] for index in xrange(len(keyed) - 1)):
+            keyed.sort()
+        return keyed
+    
+    first = ordered(times1)
+    second = ordered(times2)
+    aligned = []
+    index1 = index2 = 0
+    while index1 < len(first) and index2 < len(second):
+        key1, time1, row1 = first[index1]
+        key2, time2, row2 = second[index2]
+        if key1 == key2:
+            aligned.append((time1, row1, row2))
+            index1 += 1
+            index2 += 1
+        elif key1 < key2:
+            if fill_gaps:
+                aligned.append((time1, row1, None))
+            index1 += 1
+        else:
+            if fill_gaps:
+                aligned.append((time2, None, row2))
+            index2 += 1
+    if fill_gaps:
+        aligned.extend((time, row, None) for key, time, row in first[index1:])
+        aligned.extend((time, None, row) for key, time, row in second[index2:])
+    return aligned
+
+
+def _select_rows(matrix, rows):
+    """
+    Build a new ObservationMatrix out of some of the rows of another.  A None row is left empty.
+    """
+    selected = ObservationMatrix.__new__(ObservationMatrix)
+    selected.columns = matrix.columns
+    selected.column_index = matrix.column_index
+    selected.rows = len(rows)
+    present = [row for row in rows if row is not None]
+    if present and len(present) == len(rows) and present == range(present[0], present[0] + len(present)):
+        # A run of consecutive rows is just a shift and a mask
+        mask = (1 << len(rows)) - 1
+        selected.bits = [(bits >> present[0]) & mask for bits in matrix.bits]
+    else:
+        selected.bits = []
+        for bits in matrix.bits:
+            # Index the bitmask's binary string by row, rather than shifting the bitmask for every row
+            digits = bin(bits)[2:].zfill(matrix.rows)[::-1]
+            series = ''.join(['0' if row is None else digits[row] for row in reversed(rows)])
+            selected.bits.append(int(series, 2) if series else 0)
+    return selected
+
+
+def align_observations(eval1, eval2, fill_gaps=False):
+    """
+    Line up two observations of the same lesson which didn't start or stop at the same time.
+    
+    Returns (aligned1, aligned2, coverage), where the aligned observations only have the time
+    blocks which are being compared (see align_time_blocks), and coverage is an AlignmentCoverage
+    counting the blocks compared, the blocks of each observation which were discarded, and the
+    blocks which were filled in as empty for each observation.
+    
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> first = TeacherObservation(_write_example(directory, 'first.csv'))
+    >>> first.parse()
+    >>> second = TeacherObservation(_write_example(directory, 'second.csv', ('2,x,,,', '4,,,x,', '6,x,,,')))
+    >>> second.parse()
+    >>> aligned1, aligned2, coverage = align_observations(first, second, fill_gaps=True)
+    >>> aligned2.times, aligned2.get_matrix().column(0), coverage.compared
+    (['0', '2', '4', '6'], [0, 1, 0, 1], 4)
+    >>> shutil.rmtree(directory)
+    """
+    assert eval1.categories == eval2.categories, \
+    "The categories do not match, I can't compare these\nEval1 Categories: %s\nEval2 Categories: %s" % (eval1.categories, eval2.categories)
+    aligned = align_time_blocks(eval1.times, eval2.times, fill_gaps)
+    times = [time for time, row1, row2 in aligned]
+    rows1 = [row1 for time, row1, row2 in aligned]
+    rows2 = [row2 for time, row1, row2 in aligned]
+    first_filled = rows1.count(None)
+    second_filled = rows2.count(None)
+    coverage = AlignmentCoverage(len(aligned), len(eval1.times) - (len(aligned) - first_filled),
+                                 len(eval2.times) - (len(aligned) - second_filled), first_filled, second_filled)
+    aligned1 = TeacherObservation.from_matrix(eval1.filename, eval1.categories, times,
+                                              _select_rows(eval1.get_matrix(), rows1), eval1.compact)
+    aligned2 = TeacherObservation.from_matrix(eval2.filename, eval2.categories, list(times),
+                                              _select_rows(eval2.get_matrix(), rows2), eval2.compact)
+    return aligned1, aligned2, coverage
+
+
+def dilate(bits, radius):
+    """
+    Spread every set bit of a bitmask to its neighbours up to radius bits away on either side.
+    The radius is covered by doubling, so this takes about log2(radius) shifts.
+    
+    >>> bin(dilate(0b10000, 2))
+    '0b1111100'
+    """
+    covered = 0
+    while covered < radius:
+        step = min(covered + 1, radius - covered)
+        bits |= (bits << step) | (bits >> step)
+        covered += step
+    return bits
+
+
+def _pack_columns(matrix, stride):
+    """
+    Pack every column of a matrix into one integer, stride bits apart (stride is a multiple of 8)
+    """
+    width = stride // 8
+    return ObservationMatrix.bytes_column(''.join([ObservationMatrix.column_bytes(bits, width) for bits in matrix.bits]))
+
+
+def _unpack_columns(packed, stride, columns):
+    """
+    Split an integer made by _pack_columns back into a list of column bitmasks
+    """
+    digits = stride // 4
+    packed = ('%x' % packed).zfill(digits * columns)
+    # The first column is at the low end, which is the end of the hex string
+    return [int(packed[len(packed) - (index + 1) * digits:len(packed) - index * digits], 16)
+            for index in xrange(columns)]
+
+
+def tolerance_tables(matrix1, matrix2, window):
+    """
+    Agreement when a mark counts as matched if the other observer marked the same code within
+    window time blocks either way.
+    
+    All of the columns are packed into one integer, with window empty bits between them, so a
+    single dilation of each matrix covers every code at once, whatever the window size.
+    
+    Returns an OrderedDict mapping each (category, observation) column to a tuple of
+    (first matched, first marks, second matched, second marks).
+    
+    >>> categories = OrderedDict([('1. Instructor', ['Lec', 'CQ'])])
+    >>> first, second = ObservationMatrix(categories), ObservationMatrix(categories)
+    >>> first.rows = second.rows = 6
+    >>> first.bits, second.bits = [0b000101, 0b100000], [0b001000, 0b000001]
+    >>> tolerance_tables(first, second, 1).values()
+    [(1, 2, 1, 1), (0, 1, 0, 1)]
+    >>> tolerance_tables(first, second, 5).values()
+    [(2, 2, 1, 1), (1, 1, 1, 1)]
+    >>> empty = ObservationMatrix(categories)
+    >>> tolerance_tables(empty, empty, 0).values()
+    [(0, 0, 0, 0), (0, 0, 0, 0)]
+    """
+    assert matrix1.columns == matrix2.columns, "The columns do not match, I can't compare these"
+    assert matrix1.rows == matrix2.rows, "The number of time blocks does not match, I can't compare these"
+    # At least a byte per column, so there is something to unpack even with no time blocks
+    stride = max(8, (matrix1.rows + window + 7) // 8 * 8)
+    packed1 = _pack_columns(matrix1, stride)
+    packed2 = _pack_columns(matrix2, stride)
+    columns = len(matrix1.columns)
+    matched1 = _unpack_columns(packed1 & dilate(packed2, window), stride, columns)
+    matched2 = _unpack_columns(packed2 & dilate(packed1, window), stride, columns)
+    tables = OrderedDict()
+    for index, column in enumerate(matrix1.columns):
+        tables[column] = (popcount(matched1[index]), popcount(matrix1.bits[index]),
+                          popcount(matched2[index]), popcount(matrix2.bits[index]))
+    return tables
+
+
+def print_tolerance_agreement(eval1, eval2, window):
+    """
+    Print the agreement for every code when marks within window time blocks of each other match.
+    Returns the tables from tolerance_tables.
+    """
+    tables = tolerance_tables(eval1.get_matrix(), eval2.get_matrix(), window)
+    print "Agreement within %d time blocks (Observation code, first matched, first marks, second matched, second marks, agreement %%)" % window
+    matched = 0
+    marks = 0
+    for category, observations in eval1.categories.iteritems():
+        print category
+        for observation in observations:
+            first_matched, first_marks, second_matched, second_marks = tables[(category, observation)]
+            if first_marks + second_marks:
+                agreement = 100.0*(first_matched + second_matched)/(first_marks + second_marks)
+            else:
+                agreement = 100.0
+            print " %s, %d, %d, %d, %d, %.1f%%" % (observation, first_matched, first_marks, second_matched, second_marks, agreement)
+            matched += first_matched + second_matched
+            marks += first_marks + second_marks
+    print "Total agreement within %d time blocks: %d of %d marks (%.2f%%)\n" % (window, matched, marks, 100.0*matched/marks if marks else 100.0)
+    return tables
+
+
+class CodeStats(object):
+    """
+    The contingency counts and overlap % for one observation code in a comparison
+    """
+    __slots__ = ('category', 'observation', 'both', 'neither', 'first', 'second', 'overlap')
+    
+    def __init__(self, category, observation, both, neither, first, second, overlap):
+        self.category = category
+        self.observation = observation
+        self.both = both
+        self.neither = neither
+        self.first = first
+        self.second = second
+        self.overlap = overlap
+    
+    # Slotted classes have no __dict__, so pickle (and so the process pools) needs these
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+    
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+    
+    def __repr__(self):
+        return 'CodeStats(%s)' % ', '.join(repr(getattr(self, name)) for name in self.__slots__)
+
+
+class ComparisonResult(object):
+    """
+    Everything compare_teacher_evals works out for a pair of observations: the filled time blocks
+    of each, the stats for every code (in column order), the total overlap for every broad
+    category, the overall both/neither/first/second Counter and, if the times had to be
+    aligned, the AlignmentCoverage.
+    """
+    __slots__ = ('first_file', 'second_file', 'first_blocks', 'second_blocks', 'codes',
+                 'category_overlap', 'totals', 'coverage')
+    
+    # The columns written by write_comparisons_csv, and the keys of each JSON line.  overlap is
+    # the code's overlap %, or the sum of them for a category, and is empty on the total row.
+    # agreement is both + neither as a percentage of the row's cells.
+    FIELDS = ('first_file', 'second_file', 'level', 'category', 'observation',
+              'both', 'neither', 'first_only', 'second_only', 'overlap', 'agreement')
+    
+    def __init__(self, first_file, second_file, first_blocks, second_blocks, codes, category_overlap,
+                 totals, coverage=None):
+        self.first_file = first_file
+        self.second_file = second_file
+        self.first_blocks = first_blocks
+        self.second_blocks = second_blocks
+        self.codes = codes
+        self.category_overlap = category_overlap
+        self.totals = totals
+        self.coverage = coverage
+    
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+    
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+    
+    @property
+    def time_blocks(self):
+        return max(self.first_blocks, self.second_blocks)
+    
+    @property
+    def agreement(self):
+        """
+        The total agreement, both + neither as a percentage of every cell, or None with no cells
+        """
+        total = sum(self.totals.values())
+        if total == 0:
+            return None
+        return 100.0*(self.totals['both'] + self.totals['neither'])/total
+    
+    def category_results(self):
+        """
+        The both-match count of every code, in a list for each broad category
+        """
+        category_results = defaultdict(list)
+        for code in self.codes:
+            category_results[code.category].append(code.both)
+        return category_results
+    
+    def as_tuple(self):
+        """
+        What compare_teacher_evals has always returned: (Counter, category results, time blocks)
+        """
+        return self.totals, self.category_results(), self.time_blocks
+    
+    def records(self):
+        """
+        Yield a row of FIELDS for every code, then one for every broad category with its codes'
+        counts added up and its total overlap, then a totals row.  The agreement of the totals
+        row is the total agreement.
+        """
+        def agreement(both, neither, first, second):
+            cells = both + neither + first + second
+            return 100.0*(both + neither)/cells if cells else None
+        
+        first_file = self.first_file
+        second_file = self.second_file
+        category_counts = OrderedDict()
+        for code in self.codes:
+            yield (first_file, second_file, 'code', code.category, code.observation,
+                   code.both, code.neither, code.first, code.second, code.overlap,
+                   agreement(code.both, code.neither, code.first, code.second))
+            counts = category_counts.setdefault(code.category, [0, 0, 0, 0])
+            counts[0] += code.both
+            counts[1] += code.neither
+            counts[2] += code.first
+            counts[3] += code.second
+        for category, counts in category_counts.iteritems():
+            yield (first_file, second_file, 'category', category, None) + tuple(counts) + \
+                  (self.category_overlap[category], agreement(*counts))
+        yield (first_file, second_file, 'total', None, None, self.totals['both'], self.totals['neither'],
+               self.totals['first'], self.totals['second'], None, self.agreement)
+    
+    def print_report(self):
+        """
+        Print the comparison the way compare_teacher_evals always has
+        """
+        if self.coverage is not None:
+            print "Aligned time blocks: %d compared, %d discarded from the first and %d from the second, %d filled in for the first and %d for the second" % self.coverage
+        print "Teacher 1: %d time blocks" % self.first_blocks
+        print "Teacher 2: %d time blocks" % self.second_blocks
+        print "Category results (Observation code, both, neither, first only, second only, overlap %)"
+        codes = defaultdict(list)
+        for code in self.codes:
+            codes[code.category].append(code)
+        for category, overlap_counter in self.category_overlap.iteritems():
+            print category
+            for code in codes[category]:
+                print " %s, %d, %d, %d, %d, %.1f%%" % (code.observation, code.both, code.neither, code.first,
+                                                        code.second, code.overlap)
+            print " Total Overlap for %s: %.1f" % (category, overlap_counter)
+        cnt = self.totals
+        print """Totals:
+Both: %d
+Neither: %d
+First only: %d
+Second only: %d
+Total: %d
+Total agreement: %d (%.2f%%)
+""" % (cnt['both'], cnt['neither'], cnt['first'], cnt['second'], \
+                               sum(cnt.values()), cnt['both']+cnt['neither'], \
+                               self.agreement or 0.0)
+
+
+def write_comparisons_jsonl(results, output):
+    """
+    Write the records of a sequence of ComparisonResults to a file as JSON Lines
+    
+    >>> result = ComparisonResult('a.csv', 'b.csv', 3, 3, [CodeStats('1. Instructor', 'Lec', 2, 1, 1, 0, 50.0)],
+    ...                           OrderedDict([('1. Instructor', 50.0)]), Counter(both=2, neither=1, first=1))
+    >>> output = StringIO()
+    >>> write_comparisons_jsonl([result], output)
+    >>> print output.getvalue().splitlines()[-1]
+    {"first_file":"a.csv","second_file":"b.csv","level":"total","category":null,"observation":null,"both":2,"neither":1,"first_only":1,"second_only":0,"overlap":null,"agreement":75.0}
+    """
+    import json
+    fields = ComparisonResult.FIELDS
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    for result in results:
+        output.writelines('%s\n' % encode(OrderedDict(zip(fields, record))) for record in result.records())
+
+
+def write_comparisons_csv(results, output, header=True):
+    """
+    Write the records of a sequence of ComparisonResults to a file as csv
+    
+    >>> result = ComparisonResult('a.csv', 'b.csv', 3, 3,
+    ...                           [CodeStats('1. Instructor', 'Lec', 2, 1, 1, 0, 50.0), CodeStats('2. Students', 'L', 0, 2, 1, 1, 25.0)],
+    ...                           OrderedDict([('1. Instructor', 50.0), ('2. Students', 25.0)]),
+    ...                           Counter(both=2, neither=3, first=2, second=1))
+    >>> output = StringIO()
+    >>> write_comparisons_csv([result], output)
+    >>> for line in output.getvalue().splitlines():
+    ...     print line
+    first_file,second_file,level,category,observation,both,neither,first_only,second_only,overlap,agreement
+    a.csv,b.csv,code,1. Instructor,Lec,2,1,1,0,50.0,75.0
+    a.csv,b.csv,code,2. Students,L,0,2,1,1,25.0,50.0
+    a.csv,b.csv,category,1. Instructor,,2,1,1,0,50.0,75.0
+    a.csv,b.csv,category,2. Students,,0,2,1,1,25.0,50.0
+    a.csv,b.csv,total,,,2,3,2,1,,62.5
+    """
+    writer = csv.writer(output)
+    if header:
+        writer.writerow(ComparisonResult.FIELDS)
+    for result in results:
+        writer.writerows(result.records())
+
+
+def compare_observations(eval1, eval2, align=None):
+    """
+    Compare two observations without printing anything and return a ComparisonResult.
+    align works the same way as for compare_teacher_evals.
+    """
+    coverage = None
+    if align is not None and eval1.times != eval2.times:
+        eval1, eval2, coverage = align_observations(eval1, eval2, fill_gaps=(align == 'fill'))
+    
+    assert eval1.categories == eval2.categories, \
+    "The categories do not match, I can't compare these\nEval1 Categories: %s\nEval2 Categories: %s" % (eval1.categories, eval2.categories)
+    assert eval1.times == eval2.times, \
+    "The times do not match, I can't compare these.\nEval1 times: %s\nEvan2 times: %s" % (eval1.times, eval2.times)
+    
+    with timed_stage('compare') as record:
+        matrix1 = eval1.get_matrix()
+        matrix2 = eval2.get_matrix()
+        
+        # Get the contingency tables for every observation, along with the category and global totals
+        tables, category_totals, cnt = contingency_tables(matrix1, matrix2, eval1.code_counts.values(),
+                                                          eval2.code_counts.values())
+        
+        codes = []
+        category_overlap = OrderedDict()
+        for category, observations in eval1.categories.iteritems():
+            eval1_total_counts = eval1.category_totals[category]
+            eval2_total_counts = eval2.category_totals[category]
+            
+            overlap_counter = 0
+            for observation in observations:
+                both_match, neither_match, first_only, second_only = tables[(category, observation)]
+                
+                # A category with nothing marked (easy to get with a short overlap) has no shares
+                eval1_counts = 100*float(both_match + first_only)/eval1_total_counts if eval1_total_counts else 0.0
+                eval2_counts = 100*float(both_match + second_only)/eval2_total_counts if eval2_total_counts else 0.0
+                
+                # We calculate a general agreement for this observation by simply taking the lesser of eval1_counts and eval2_counts
+                overlap = min(eval1_counts, eval2_counts)
+                overlap_counter += overlap
+                codes.append(CodeStats(category, observation, both_match, neither_match, first_only, second_only, overlap))
+            category_overlap[category] = overlap_counter
+        
+        record['cells'] = 2 * matrix1.rows * len(matrix1.columns)
+    return ComparisonResult(eval1.filename, eval2.filename, eval1.filled_time_intervals, eval2.filled_time_intervals,
+                            codes, category_overlap, cnt, coverage)
+
+
+def compare_teacher_evals(eval1, eval2, align=None, tolerance=0, quiet=False):
+    """
+    Returns a Counter with the following keys:
+    both, neither, first, second
+    
+    If the observations have different times, align can be 'overlap' to only compare the time
+    blocks they both have, or 'fill' to compare every time block either of them has, counting
+    missing blocks as empty.
+    
+    If tolerance is more than 0, the agreement when marks up to that many time blocks apart
+    count as matching is printed as well.  With quiet, nothing is printed at all; use
+    compare_observations to get everything as a ComparisonResult instead.
+    """
+    result = compare_observations(eval1, eval2, align)
+    if not quiet:
+        result.print_report()
+        if tolerance:
+            if result.coverage is not None:
+                eval1, eval2, coverage = align_observations(eval1, eval2, fill_gaps=(align == 'fill'))
+            print_tolerance_agreement(eval1, eval2, tolerance)
+    return result.as_tuple()
+    
+
+Reliability = namedtuple('Reliability', ['kappa', 'kappa_ci', 'pabak', 'pabak_ci', 'alpha', 'alpha_ci'])
+
+
+def reliability_statistics(both, neither, first, second):
+    """
+    Cohen's kappa, prevalence-adjusted bias-adjusted kappa and Krippendorff's alpha (two coders,
+    binary nominal data) for a 2x2 contingency table.  A statistic which isn't defined for the
+    table, such as kappa when neither observer ever used a code, is None.
+    
+    >>> ['%.3f' % statistic for statistic in reliability_statistics(20, 60, 10, 10)]
+    ['0.524', '0.600', '0.526']
+    """
+    total = both + neither + first + second
+    if total == 0:
+        return None, None, None
+    observed = float(both + neither)/total
+    first_share = float(both + first)/total
+    second_share = float(both + second)/total
+    expected = first_share*second_share + (1 - first_share)*(1 - second_share)
+    kappa = (observed - expected)/(1 - expected) if expected < 1 else None
+    pabak = 2*observed - 1
+    # Krippendorff's alpha from the coincidence matrix, which has 2 * total values
+    values = 2*total
+    marked = 2*both + first + second
+    unmarked = 2*neither + first + second
+    alpha = 1 - float(values - 1)*(first + second)/(marked*unmarked) if marked and unmarked else None
+    return kappa, pabak, alpha
+
+
+def _percentile_interval(values, confidence):
+    """
+    The percentile bootstrap interval of a list of replicate values, ignoring any Nones
+    """
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    tail = (1 - confidence)/2
+    return (values[int(round(tail*(len(values) - 1)))], values[int(round((1 - tail)*(len(values) - 1)))])
+
+
+def _bootstrap_tables(masks, rows, replicates, seed):
+    """
+    Bootstrap the contingency tables of every code by resampling time blocks with replacement.
+    
+    masks is a list of (both, first only, second only) bitmasks, one per code.  Each replicate
+    draws a weight for every time block (how many times it was picked), and the weights are
+    split into bit planes: plane k has the blocks whose weight has bit k set.  A code's count is
+    then the sum of 2**k * popcount(mask & plane k), so a replicate costs a few popcounts per
+    code rather than a pass over every block.
+    
+    replicates is the range of replicate numbers to run.  Each one has its own random generator,
+    seeded from seed and its number, so the results don't depend on how the replicates are
+    split between processes.
+    
+    Returns a list of replicates, each a list of (both, neither, first, second) per code.
+    """
+    results = []
+    for replicate in replicates:
+        generator = random.Random((seed << 32) + replicate)
+        weights = [0] * rows
+        for draw in xrange(rows):
+            weights[generator.randrange(rows)] += 1
+        planes = []
+        plane_bit = 1
+        while plane_bit <= rows:
+            plane = 0
+            for row, weight in enumerate(weights):
+                if weight & plane_bit:
+                    plane |= 1 << row
+            if plane:
+                planes.append((plane_bit, plane))
+            plane_bit <<= 1
+        tables = []
+        for both_mask, first_mask, second_mask in masks:
+            both = first = second = 0
+            for plane_bit, plane in planes:
+                both += plane_bit * popcount(both_mask & plane)
+                first += plane_bit * popcount(first_mask & plane)
+                second += plane_bit * popcount(second_mask & plane)
+            tables.append((both, rows - both - first - second, first, second))
+        results.append(tables)
+    return results
+
+
+def _bootstrap_worker(arguments):
+    return _bootstrap_tables(*arguments)
+
+
+def reliability_suite(eval1, eval2, replicates=1000, confidence=0.95, seed=None, processes=1):
+    """
+    Inter-rater reliability for every code, every broad category and overall: Cohen's kappa,
+    prevalence-adjusted kappa and Krippendorff's alpha, each with a bootstrap confidence
+    interval from resampling time blocks.
+    
+    The point estimates come from the same contingency tables as compare_teacher_evals, and the
+    categories and overall estimates pool the tables of their codes.  The replicates can be
+    split over a process pool.
+    
+    Returns (codes, categories, overall), where codes is an OrderedDict of Reliability keyed by
+    (category, observation), categories is keyed by broad category, and overall is a Reliability.
+    """
+    matrix1 = eval1.get_matrix()
+    matrix2 = eval2.get_matrix()
+    tables, category_totals, totals = contingency_tables(matrix1, matrix2)
+    columns = matrix1.columns
+    rows = matrix1.rows
+    masks = []
+    for first_bits, second_bits in zip(matrix1.bits, matrix2.bits):
+        both_bits = first_bits & second_bits
+        masks.append((both_bits, first_bits ^ both_bits, second_bits ^ both_bits))
+    
+    # Run the replicates, in chunks if there is a pool to spread them over
+    if seed is None:
+        seed = random.randrange(2**31)
+    if rows == 0:
+        replicate_tables = []
+    elif processes and processes > 1:
+        chunks = [(masks, rows, xrange(index, replicates, processes), seed) for index in range(processes)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            replicate_tables = list(itertools.chain.from_iterable(pool.map(_bootstrap_worker, chunks)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        replicate_tables = _bootstrap_tables(masks, rows, xrange(replicates), seed)
+    
+    def estimate(table, replicate_stats):
+        kappa, pabak, alpha = reliability_statistics(*table)
+        return Reliability(kappa, _percentile_interval([stats[0] for stats in replicate_stats], confidence),
+                           pabak, _percentile_interval([stats[1] for stats in replicate_stats], confidence),
+                           alpha, _percentile_interval([stats[2] for stats in replicate_stats], confidence))
+    
+    def pool_tables(tables):
+        return tuple(sum(table[index] for table in tables) for index in range(4))
+    
+    codes = OrderedDict()
+    for index, column in enumerate(columns):
+        codes[column] = estimate(tables[column], [reliability_statistics(*replicate[index])
+                                                  for replicate in replicate_tables])
+    categories = OrderedDict()
+    for category in eval1.categories:
+        indexes = [index for index, column in enumerate(columns) if column[0] == category]
+        categories[category] = estimate(pool_tables([tables[columns[index]] for index in indexes]),
+                                        [reliability_statistics(*pool_tables([replicate[index] for index in indexes]))
+                                         for replicate in replicate_tables])
+    overall = estimate(pool_tables(tables.values()),
+                       [reliability_statistics(*pool_tables(replicate)) for replicate in replicate_tables])
+    return codes, categories, overall
+
+
+def print_reliability(codes, categories, overall, confidence=0.95):
+    """
+    Print the output of reliability_suite
+    """
+    def show(value, interval):
+        if value is None:
+            return 'NA'
+        if interval is None:
+            return '%.3f' % value
+        return '%.3f [%.3f, %.3f]' % ((value,) + interval)
+    
+    def line(name, estimate):
+        print " %s, %s, %s, %s" % (name, show(estimate.kappa, estimate.kappa_ci),
+                                   show(estimate.pabak, estimate.pabak_ci), show(estimate.alpha, estimate.alpha_ci))
+    
+    print "Reliability (Observation code, Cohen's kappa, PABAK, Krippendorff's alpha, with %d%% bootstrap intervals)" % round(100*confidence)
+    for category, estimate in categories.iteritems():
+        print category
+        for (code_category, observation), code_estimate in codes.iteritems():
+            if code_category == category:
+                line(observation, code_estimate)
+        line('All of %s' % category, estimate)
+    line('Overall', overall)
+    print
+
+
+REPORT_STYLE = """
         .plot {width:700px;height:250px}
-    </style>
-    <!--Load the AJAX API-->
-    <script src="http://ajax.googleapis.com/ajax/libs/jquery/1.8.2/jquery.min.js"></script>
-    <script src="http://code.highcharts.com/highcharts.js"></script>
-    <script src="http://code.highcharts.com/modules/exporting.js"></script>
-    <script>
-      $(function () {
-        var times = %s; 
-
-        var columnChartOptions = {
-               chart: {
-                    type: 'column',
-                    height: 200,
-                    width: 700,
-                    borderColor: '#CCC',
-                    borderWidth: 2
-                },
-                xAxis: {
-                    categories: times
-                },
-                yAxis: {
-                    min: 0,
-                    max: 2,
-                    minTickInterval: 1,
-                    stackLabels: {
-                        enabled: false,
-                        style: {
-                            fontWeight: 'bold',
-                            color: (Highcharts.theme && Highcharts.theme.textColor) || 'gray'
-                        }
-                    }
-                },
-                legend: {
-                    align: 'right',
-                    verticalAlign: 'middle',
-                    floating: false,
-                    layout: 'vertical',
-                    backgroundColor: (Highcharts.theme && Highcharts.theme.legendBackgroundColorSolid) || 'white',
-                    borderColor: '#CCC',
-                    borderWidth: 1,
-                    shadow: false
-                },
-                tooltip: {
-                    formatter: function() {
-                        return '<b>'+ this.x +'</b><br/>'+
-                            this.series.name +': '+ this.y +'<br/>'+
-                            'Total: '+ this.point.stackTotal;
-                    }
-                },
-                plotOptions: {
-                    column: {
-                        stacking: 'normal'
+        .pie {width:700px;height:500px}
+"""
+
+REPORT_SCRIPT = """
+    var columnChartOptions = {
+           chart: {
+                type: 'column',
+                height: 200,
+                width: 700,
+                borderColor: '#CCC',
+                borderWidth: 2
+            },
+            yAxis: {
+                min: 0,
+                max: 2,
+                minTickInterval: 1,
+                stackLabels: {
+                    enabled: false,
+                    style: {
+                        fontWeight: 'bold',
+                        color: (Highcharts.theme && Highcharts.theme.textColor) || 'gray'
                     }
                 }
-          };
-          
-    var bothColumnChartOptions = {
-                   chart: {
-                    type: 'column',
-                    height: 200,
-                    width: 700,
-                    borderColor: '#CCC',
-                    borderWidth: 2
-                },
+            },
+            legend: {
+                align: 'right',
+                verticalAlign: 'middle',
+                floating: false,
+                layout: 'vertical',
+                backgroundColor: (Highcharts.theme && Highcharts.theme.legendBackgroundColorSolid) || 'white',
+                borderColor: '#CCC',
+                borderWidth: 1,
+                shadow: false
+            },
+            tooltip: {
+                formatter: function() {
+                    return '<b>'+ this.x +'</b><br/>'+
+                        this.series.name +': '+ this.y +'<br/>'+
+                        'Total: '+ this.point.stackTotal;
+                }
+            },
+            plotOptions: {
+                column: {
+                    stacking: 'normal'
+                }
+            }
+    };
 
-                yAxis: {
-                    min: 0,
-                    max: 100,
-                    stackLabels: {
-                        enabled: false,
-                        style: {
-                            fontWeight: 'bold',
-                            color: (Highcharts.theme && Highcharts.theme.textColor) || 'gray'
-                        }
-                    },
-                    title: {
-                        text: '%% of total time blocks'
-                    }
-                },
-                legend: {
-                    enabled: false
-                },
-                tooltip: {
-                    formatter: function() {
-                        return '<b>'+ this.x +'</b><br/>'+
-                            this.series.name +': '+ this.y;
+    var bothColumnChartOptions = {
+           chart: {
+                type: 'column',
+                height: 200,
+                width: 700,
+                borderColor: '#CCC',
+                borderWidth: 2
+            },
+            yAxis: {
+                min: 0,
+                max: 100,
+                stackLabels: {
+                    enabled: false,
+                    style: {
+                        fontWeight: 'bold',
+                        color: (Highcharts.theme && Highcharts.theme.textColor) || 'gray'
                     }
                 },
-                plotOptions: {
-                    column: {
-                        stacking: 'normal'
-                    }
+                title: {
+                    text: '% of total time blocks'
+                }
+            },
+            legend: {
+                enabled: false
+            },
+            tooltip: {
+                formatter: function() {
+                    return '<b>'+ this.x +'</b><br/>'+
+                        this.series.name +': '+ this.y;
                 }
+            },
+            plotOptions: {
+                column: {
+                    stacking: 'normal'
+                }
+            }
     };
-          
+
     var pieChartOptions = {
             chart: {
                 plotBackgroundColor: null,
@@ -373,11 +2475,9 @@ def html_output(eval1, eval2, output_file, category_result, time_blocks):
                 plotShadow: false,
                 width: '700',
                 height: '500'
-                
             },
-
             tooltip: {
-                pointFormat: '{series.name}: <b>{point.percentage}%%</b> (<b>{point.y}</b>)',
+                pointFormat: '{series.name}: <b>{point.percentage}%</b> (<b>{point.y}</b>)',
                 percentageDecimals: 1
             },
             plotOptions: {
@@ -385,168 +2485,1294 @@ def html_output(eval1, eval2, output_file, category_result, time_blocks):
                     allowPointSelect: true,
                     cursor: 'pointer',
                     dataLabels: {
-                        enabled: false,
+                        enabled: false
                     },
                     showInLegend: true
                 }
             },
             legend: {
-                    align: 'right',
-                    verticalAlign: 'middle',
-                    floating: false,
-                    layout: 'vertical',
-                    backgroundColor: (Highcharts.theme && Highcharts.theme.legendBackgroundColorSolid) || 'white',
-                    borderColor: '#CCC',
-                    borderWidth: 1,
-                    shadow: false
+                align: 'right',
+                verticalAlign: 'middle',
+                floating: false,
+                layout: 'vertical',
+                backgroundColor: (Highcharts.theme && Highcharts.theme.legendBackgroundColorSolid) || 'white',
+                borderColor: '#CCC',
+                borderWidth: 1,
+                shadow: false
+            }
+    };
+
+    // The 0/1 series are sent as the hex digits of a bitmask, with time block 0 in the lowest bit
+    function decodeSeries(hex, length) {
+        var data = [];
+        for (var i = 0; i < length; i++) {
+            var position = hex.length - 1 - (i >> 2);
+            var digit = position >= 0 ? parseInt(hex.charAt(position), 16) : 0;
+            data.push((digit >> (i & 3)) & 1);
+        }
+        return data;
+    }
+
+    function renderChart(report, chart) {
+        var type = chart[0], id = chart[1];
+        if (type == 'column') {
+            $('#' + id).highcharts($.extend({}, {
+                title: {text: chart[2]},
+                xAxis: {categories: report.times},
+                series: [{name: 'Teacher 1', data: decodeSeries(chart[3], report.times.length)},
+                         {name: 'Teacher 2', data: decodeSeries(chart[4], report.times.length)}]
+            }, columnChartOptions));
+        } else if (type == 'both') {
+            $('#' + id).highcharts($.extend({}, {
+                title: {text: chart[2]},
+                xAxis: {categories: chart[3]},
+                series: [{name: 'observation', data: chart[4]}]
+            }, bothColumnChartOptions));
+        } else if (type == 'pie') {
+            var data = [];
+            for (var i = 0; i < chart[3].length; i++) {
+                data.push({name: chart[3][i], y: chart[4][i], dataLabels: {enabled: chart[4][i] > 0}});
+            }
+            $('#' + id).highcharts($.extend({}, {
+                title: {text: chart[2]},
+                series: [{type: 'pie', name: 'Observation', data: data}]
+            }, pieChartOptions));
+        }
+    }
+
+    // Only draw the charts once they are close to being scrolled into view
+    function renderLazily(report) {
+        var pending = report.charts.slice();
+        function renderVisible() {
+            var bottom = $(window).scrollTop() + $(window).height() + 500;
+            pending = $.grep(pending, function(chart) {
+                if ($('#' + chart[1]).offset().top < bottom) {
+                    renderChart(report, chart);
+                    return false;
                 }
-        };
-""" % (os.path.basename(output_file), json.dumps(eval1.times))
-    output = head
+                return true;
+            });
+            if (!pending.length) {
+                $(window).off('scroll resize', renderVisible);
+            }
+        }
+        $(window).on('scroll resize', renderVisible);
+        renderVisible();
+    }
+"""
+
 
-    column_chart_additional_options = tree()
-    chart_functions = []
-    column_chart_div_ids = []
+REPORT_ASSETS = ('teacherobservations.css', 'teacherobservations.js')
+
+
+def write_report_assets(directory):
+    """
+    Write the style and script shared by every report into a directory, for reports made with
+    html_output(..., assets=REPORT_ASSETS) in the same directory
+    """
+    css, js = REPORT_ASSETS
+    with open(os.path.join(directory, css), 'w') as f:
+        f.write(REPORT_STYLE)
+    with open(os.path.join(directory, js), 'w') as f:
+        f.write(REPORT_SCRIPT)
+    return REPORT_ASSETS
+
+
+def _write_report_charts(f, eval1, eval2, category_result, time_blocks, between=''):
+    """
+    Write the chart data script for a report, then between, then a div for each chart.
+    The script needs renderLazily from REPORT_SCRIPT.
+    """
+    import json
+    
+    def get_title(category, observation):
+       return "%s: %s" % (category, observation)  
+    
+    def get_css_name(name):
+        return name.translate(None, r"""!"#$%&'()*+,./:;<=>?@[\]^`{|}~ 0123456789""")
+    
+    matrix1 = eval1.get_matrix()
+    matrix2 = eval2.get_matrix()
     
-    # Add the column chart data
+    f.write("""    <script>
+      $(function () {
+        var report = {times: %s, charts: [
+""" % json.dumps(eval1.times))
+    
+    div_ids = []
+    # Add the column chart data, one chart per observation
     for category, observations in eval1.categories.iteritems():
         for observation in observations:
             title = get_title(category, observation)
             id = get_css_name(title)
-            column_chart_additional_options[id]['title']['text'] = title
-            column_chart_additional_options[id]['series'] = \
-                [
-                  {'name': 'Teacher 1',
-                   'data': eval1.results[category][observation]
-                   },
-                   {'name': 'Teacher 2',
-                    'data': eval2.results[category][observation]
-                    }
-                ]
-            chart_functions.append("""$(%s).highcharts($.extend({}, column_chart_additional_options['%s'], columnChartOptions))""" % (id, id))
-            column_chart_div_ids.append(id)
-    
+            column = matrix1.column_index[(category, observation)]
+            f.write('%s,\n' % json.dumps(['column', id, title, '%x' % matrix1.bits[column], '%x' % matrix2.bits[column]]))
+            div_ids.append((id, 'plot'))
     
     # Do the new both agree column chart thing
-    both_column_chart_additional_options = tree()
-    
     for category, observations in eval1.categories.iteritems():
-        title = category
-        id = get_css_name(title)+'both'
-        both_column_chart_additional_options[id]['title']['text'] = category
-        both_column_chart_additional_options[id]['xAxis']['categories'] = observations
-        both_column_chart_additional_options[id]['series'] = [{'name':'observation', 'data': []}]
-        for index, observation in enumerate(observations):
-            both_column_chart_additional_options[id]['series'][0]['data'].append(100*float(category_result[category][index])/time_blocks)
-        
-        chart_functions.append("""$(%s).highcharts($.extend({}, both_column_chart_additional_options['%s'], bothColumnChartOptions))""" % (id, id))
-        column_chart_div_ids.append(id)
-    
-    
-    pie_chart_additional_options = tree()
-    pie_chart_div_ids = []
+        id = get_css_name(category)+'both'
+        data = [100*float(both)/time_blocks if time_blocks else 0.0 for both in category_result[category]]
+        f.write('%s,\n' % json.dumps(['both', id, category, observations, data]))
+        div_ids.append((id, 'plot'))
     
     # Add the pie chart data
     for category, observations in eval1.categories.iteritems():
         id = get_css_name(category) + 'pie'
-        pie_chart_div_ids.append(id)
-        pie_chart_additional_options[id]['title']['text'] = category
-        pie_chart_additional_options[id]['series'] = \
-            [
-                {'type': 'pie',
-                 'name': 'Observation',
-                 'data': []
-                }
-            ]
-        for index, observation in enumerate(observations):
-            value = round(category_result[category][index],1)
-            pie_chart_additional_options[id]['series'][0]['data'].append({'name': observation,
-                             'y': value,
-                             'dataLabels': {'enabled': True if value>0 else False}
-                             
-                             })
-        chart_functions.append("""$(%s).highcharts($.extend({}, pie_chart_additional_options['%s'], pieChartOptions))""" % (id, id))
-        
-        
-        
+        data = [round(both, 1) for both in category_result[category]]
+        f.write('%s,\n' % json.dumps(['pie', id, category, observations, data]))
+        div_ids.append((id, 'pie'))
+    
+    # Close the script tags
+    f.write("""        ]};
+        renderLazily(report);
+      });
+    </script>
+""")
+    f.write(between)
+    for id, css_class in div_ids:
+        f.write('<div id="%s" class="%s"></div>\n' % (id, css_class))
+
+
+def html_output(eval1, eval2, output_file, category_result, time_blocks, assets=None):
+    """
+    A quick and dirty attempt at making some plots
+    
+    The page is written out as it is built.  Each 0/1 series is sent as the hex digits of its
+    bitmask and decoded in the browser, and each chart is only drawn once it gets close to being
+    scrolled into view, so long sessions with lots of codes stay small and quick to open.
+    
+    If assets is a (css, js) pair of paths, the page links to those instead of including the
+    style and chart options itself (see write_report_assets).
+    """
+    if assets is None:
+        style = '<style>%s    </style>' % REPORT_STYLE
+        script = '<script>%s    </script>' % REPORT_SCRIPT
+    else:
+        style = '<link rel="stylesheet" href="%s">' % assets[0]
+        script = '<script src="%s"></script>' % assets[1]
+    
+    with timed_stage('html') as record:
+        with open(output_file, 'w') as f:
+            f.write("""<!DOCTYPE html>
+<html>
+  <head>
+    <title>
+        %s
+    </title>
+    %s
+    <script src="http://ajax.googleapis.com/ajax/libs/jquery/1.8.2/jquery.min.js"></script>
+    <script src="http://code.highcharts.com/highcharts.js"></script>
+    <script src="http://code.highcharts.com/modules/exporting.js"></script>
+    %s
+""" % (os.path.basename(output_file), style, script))
+            _write_report_charts(f, eval1, eval2, category_result, time_blocks, """</head>
+<body>
+""")
+            # End the page
+            f.write("""</body>
+</html>""")
+            record['output_bytes'] = f.tell()
+
+
+def html_fragment(eval1, eval2, category_result, time_blocks):
+    """
+    The charts of a report as a piece of html to put into another page, which has to load
+    jQuery, Highcharts and the REPORT_ASSETS itself
+    """
+    f = StringIO()
+    _write_report_charts(f, eval1, eval2, category_result, time_blocks)
+    return f.getvalue()
+
+
+def report_filename(first, second):
+    """
+    The name of the html report for a pair of observation files
+    """
+    return '%s--%s.html' % (os.path.splitext(os.path.basename(first))[0],
+                            os.path.splitext(os.path.basename(second))[0])
+
+
+def pair_report(eval1, eval2, output_file, assets=None, align=None):
+    """
+    Write the html report for a pair of observations, without printing the comparison
+    """
+    if align is not None and eval1.times != eval2.times:
+        eval1, eval2, coverage = align_observations(eval1, eval2, fill_gaps=(align == 'fill'))
+    tables, category_totals, cnt = contingency_tables(eval1.get_matrix(), eval2.get_matrix(),
+                                                      eval1.code_counts.values(), eval2.code_counts.values())
+    category_result = defaultdict(list)
+    for (category, observation), table in tables.iteritems():
+        category_result[category].append(table[0])
+    time_blocks = max(eval1.filled_time_intervals, eval2.filled_time_intervals)
+    html_output(eval1, eval2, output_file, category_result, time_blocks, assets)
+
+
+LoadResult = namedtuple('LoadResult', ['filename', 'observation', 'error'])
+
+
+def _parse_content(filename, data, compact):
+    """
+    Parse the contents of an observation file, in a worker process
+    """
+    return TeacherObservation.from_file(filename, StringIO(data), compact)
+
+
+def load_observations(filenames, threads=8, processes=0, max_in_flight=None, compact=True, cache=None):
+    """
+    Load many observation files at once, for files on slow disks or network shares.
     
+    A pool of threads reads the files, and parses them too unless processes is given, in which
+    case the parsing is handed to a process pool.  No more than max_in_flight files (by default
+    four per thread) are being worked on at once, so filenames can be a long running generator.
     
-    output += """\nvar column_chart_additional_options = %s;\n""" % json.dumps(column_chart_additional_options)
-    output += """\nvar both_column_chart_additional_options = %s;\n""" % json.dumps(both_column_chart_additional_options)
-    output += """\nvar pie_chart_additional_options = %s;\n""" % json.dumps(pie_chart_additional_options)
+    Yields a LoadResult for each file as soon as it is done, so the order isn't the order of
+    filenames.  If a file can't be loaded, its error is reported in the LoadResult and the rest
+    of the files carry on.
     
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> filenames = [_write_example(directory, name) for name in ('a.csv', 'b.csv', 'c.csv')]
+    >>> results = sorted(load_observations(filenames[:2] + [os.path.join(directory, 'missing.csv')] + filenames[2:], threads=2))
+    >>> [(os.path.basename(result.filename), result.observation is not None, type(result.error).__name__) for result in results]
+    [('a.csv', True, 'NoneType'), ('b.csv', True, 'NoneType'), ('c.csv', True, 'NoneType'), ('missing.csv', False, 'IOError')]
+    >>> results[0].observation.code_counts[('1. Instructor', 'Lec')]
+    2
     
-    for chart_function in chart_functions:
-        output += "        %s\n" % chart_function
+    Stopping early leaves no threads behind
     
+    >>> running = threading.active_count()
+    >>> loader = load_observations(filenames * 10, threads=3, max_in_flight=4)
+    >>> next(loader).error
+    >>> loader.close()
+    >>> threading.active_count() == running
+    True
+    >>> load_observations(filenames, threads=0)
+    Traceback (most recent call last):
+    ValueError: threads must be at least 1
+    >>> shutil.rmtree(directory)
+    """
+    if threads < 1:
+        raise ValueError("threads must be at least 1")
+    if max_in_flight is not None and max_in_flight < 1:
+        raise ValueError("max_in_flight must be at least 1")
+    return _load_observations(iter(filenames), threads, processes, max_in_flight or 4 * threads, compact, cache)
+
+
+def _load_observations(filenames, threads, processes, max_in_flight, compact, cache):
+    """
+    The generator behind load_observations, kept apart so bad arguments are reported straight away
+    """
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    pool = multiprocessing.Pool(processes) if processes else None
+
+    def load():
+        while True:
+            filename = tasks.get()
+            if filename is None:
+                return
+            try:
+                observation = TeacherObservation(filename, compact)
+                if cache is None or not cache.load(observation):
+                    with timed_stage('read') as record:
+                        with open(filename, 'rb') as csvfile:
+                            data = csvfile.read()
+                        record['bytes_read'] = len(data)
+                    if pool is not None:
+                        observation = pool.apply_async(_parse_content, (filename, data, compact)).get()
+                    else:
+                        observation.parse_file(StringIO(data))
+                    if cache is not None:
+                        cache.store(observation)
+                results.put(LoadResult(filename, observation, None))
+            except Exception as error:
+                results.put(LoadResult(filename, None, error))
+
+    workers = [threading.Thread(target=load) for index in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        in_flight = 0
+        exhausted = False
+        while True:
+            # Keep the threads busy, without getting too far ahead
+            while not exhausted and in_flight < max_in_flight:
+                try:
+                    tasks.put(next(filenames))
+                    in_flight += 1
+                except StopIteration:
+                    exhausted = True
+            if in_flight == 0:
+                break
+            result = results.get()
+            in_flight -= 1
+            yield result
+    finally:
+        # If the caller stopped early, drop the files which haven't been started on, then wait
+        # for the threads to finish, since they may still be using the pool
+        try:
+            while True:
+                tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def find_observation_files(path):
+    """
+    Expand a directory or a glob pattern into a sorted list of observation files.
+    A directory means every .csv file inside of it.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, '*.csv')
+    return sorted(glob.glob(path))
+
+
+# The parsed observations, shared with the pair comparison workers when the pool starts up
+_pair_observations = []
+_pair_align = None
+_pair_details = False
+
+def _init_pair_worker(observations, align=None, details=False):
+    global _pair_observations, _pair_align, _pair_details
+    _pair_observations = observations
+    _pair_align = align
+    _pair_details = details
+
+
+def total_agreement(eval1, eval2, align=None):
+    """
+    Work out the total agreement (both + neither as a percentage of all cells) for a pair of
+    observations, without printing anything.  Pairs which can't be compared get None.
+    align works the same way as for compare_teacher_evals.
+    """
+    if eval1.categories != eval2.categories:
+        return None
+    if eval1.times != eval2.times:
+        if align is None:
+            return None
+        eval1, eval2, coverage = align_observations(eval1, eval2, fill_gaps=(align == 'fill'))
+    tables, category_totals, cnt = contingency_tables(eval1.get_matrix(), eval2.get_matrix(),
+                                                      eval1.code_counts.values(), eval2.code_counts.values())
+    total = sum(cnt.values())
+    if total == 0:
+        return None
+    return 100.0*(cnt['both']+cnt['neither'])/total
+
+
+def _compare_pair(pair):
+    """
+    Work out the total agreement for one pair of the shared observations
+    """
+    first, second = pair
+    eval1 = _pair_observations[first]
+    eval2 = _pair_observations[second]
+    if not _pair_details:
+        return pair, total_agreement(eval1, eval2, _pair_align)
+    if eval1.categories != eval2.categories or (eval1.times != eval2.times and _pair_align is None):
+        return pair, None
+    return pair, compare_observations(eval1, eval2, _pair_align)
+
+
+def compare_all_pairs(observations, processes=None, align=None, details=False):
+    """
+    Compare every pair out of a list of parsed observations, N*(N-1)/2 comparisons in all.
+    The pairs are spread over a process pool.  The observations are handed to each worker once
+    when the pool starts (on fork they are simply inherited), so nothing gets re-parsed or
+    re-sent for each pair.
     
+    Returns a dict mapping (first index, second index) to the total agreement percentage,
+    or None if the pair couldn't be compared because the categories or times don't match.
+    With details, the dict has the whole ComparisonResult for each pair instead.
     
-#    # Add the pie chart data
-#    # Iterate over the broad categories (teachers doing/students doing)
-#    for category, observations in eval1.categories.iteritems():
-#        data = [['observation', 'overlap']]
-#        for index, observation in enumerate(observations):
-#            data.append([observation, round(category_result[category][index],1)])
-#        output += """data["%s"] = google.visualization.arrayToDataTable(%s);\n""" % (category, json.dumps(data))
-#        
-#    # Add the pie chart functions
-#    for category in eval1.categories.keys():
-#        output += """new google.visualization.PieChart(document.getElementById('%s')).
-#                        draw(data["%s"], {title: "%s", sliceVisibilityThreshold:0, pieSliceText: 'percentage'});
-#                  """ % (category, category, category)
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> filenames = [_write_example(directory, 'a.csv'),
+    ...              _write_example(directory, 'b.csv', ('0,x,,,', '2,,x,,', '4,x,,,')),
+    ...              _write_example(directory, 'c.csv', ('0,x,,x,', '2,,x,,', '6,x,x,,'))]
+    >>> observations = [TeacherObservation(filename) for filename in filenames]
+    >>> for observation in observations:
+    ...     observation.parse()
+    >>> agreements = compare_all_pairs(observations, processes=2)
+    >>> sorted(agreements.items())
+    [((0, 1), 77.77777777777777), ((0, 2), None), ((1, 2), None)]
+    >>> output = StringIO()
+    >>> agreement_matrix_output(filenames, agreements, output)
+    >>> for line in output.getvalue().splitlines():
+    ...     print line
+    ,a.csv,b.csv,c.csv
+    a.csv,100.00,77.78,NA
+    b.csv,77.78,100.00,NA
+    c.csv,NA,NA,100.00
+    >>> shutil.rmtree(directory)
+    """
+    pairs = list(itertools.combinations(range(len(observations)), 2))
+    if processes == 1 or len(pairs) < 2:
+        _init_pair_worker(observations, align, details)
+        return dict(_compare_pair(pair) for pair in pairs)
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, _init_pair_worker, (observations, align, details))
+    try:
+        chunksize = max(1, len(pairs) // (4 * processes))
+        return dict(pool.imap_unordered(_compare_pair, pairs, chunksize))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def agreement_matrix_output(filenames, agreements, output):
+    """
+    Write out the agreement matrix as csv, one row and column per observation file.
+    Pairs which couldn't be compared are written as NA.
+    """
+    names = [os.path.basename(filename) for filename in filenames]
+    writer = csv.writer(output)
+    writer.writerow([''] + names)
+    for row, name in enumerate(names):
+        line = [name]
+        for column in range(len(names)):
+            if row == column:
+                agreement = 100.0
+            else:
+                agreement = agreements[(min(row, column), max(row, column))]
+            line.append('NA' if agreement is None else '%.2f' % agreement)
+        writer.writerow(line)
+
+
+def run_lengths(bits):
+    """
+    The lengths of the runs of consecutive marked time blocks in a bitmask, in time order.
+    A run starts at a set bit whose previous bit is clear and ends at a set bit whose next
+    bit is clear, so the starts and ends pair up in order.
     
-    # Close the script tags and start the body
-    output += """});
-    </script>
+    >>> run_lengths(0b1110011010)
+    [1, 2, 3]
+    """
+    starts = bits & ~(bits << 1)
+    ends = bits & ~(bits >> 1)
+    lengths = []
+    while starts:
+        start = starts & -starts
+        end = ends & -ends
+        lengths.append(end.bit_length() - start.bit_length() + 1)
+        starts ^= start
+        ends ^= end
+    return lengths
+
+
+def session_sequences(observation):
+    """
+    Count the code transitions and run lengths in one observation.
+    
+    transitions maps (from column, to column) to how many times a time block marked with the
+    first code was followed by one marked with the second, which is popcount(A & (B >> 1)) for
+    the columns' bitmasks.  runs maps (column, length) to how many runs of that many marked time
+    blocks in a row there were.  Only the counts which aren't zero are kept.
+    Returns (transitions, runs) as Counters.
+    """
+    matrix = observation.get_matrix()
+    marked = [(column, bits) for column, bits in zip(matrix.columns, matrix.bits) if bits]
+    transitions = Counter()
+    runs = Counter()
+    for column, bits in marked:
+        for length in run_lengths(bits):
+            runs[(column, length)] += 1
+    for to_column, to_bits in marked:
+        following = to_bits >> 1
+        if not following:
+            continue
+        for from_column, from_bits in marked:
+            count = popcount(from_bits & following)
+            if count:
+                transitions[(from_column, to_column)] = count
+    return transitions, runs
+
+
+def _session_sequences_file(filename):
+    """
+    Count one file's transitions and runs, in a worker process.
+    Returns (filename, transitions, runs, error), where error is None unless the file couldn't be parsed.
+    """
+    try:
+        observation = TeacherObservation(filename, compact=True)
+        observation.parse()
+    except Exception as error:
+        return filename, None, None, error
+    transitions, runs = session_sequences(observation)
+    # Plain dicts so they can go through marshal in the SequenceCache
+    return filename, dict(transitions), dict(runs), None
+
+
+class SequenceCache(object):
+    """
+    The transitions and runs of each session, saved to one file with marshal, so adding sessions
+    to a corpus only means counting the new ones.  Entries are keyed by path and only used while
+    the file's mtime and size haven't changed.
+    
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> filenames = [_write_example(directory, 'first.csv'), _write_example(directory, 'second.csv', ('0,x,,,', '2,x,,,'))]
+    >>> cache = SequenceCache(os.path.join(directory, 'sequences'))
+    >>> transitions, runs, errors = corpus_sequences(iter(filenames), processes=1, cache=cache)
+    >>> cached = SequenceCache(cache.path)
+    >>> sorted(os.path.basename(filename) for filename in cached.entries)
+    ['first.csv', 'second.csv']
+    >>> corpus_sequences(filenames, processes=1, cache=cached) == (transitions, runs, [])
+    True
+    >>> runs[(('1. Instructor', 'Lec'), 2)], transitions[(('1. Instructor', 'Lec'), ('1. Instructor', 'Lec'))]
+    (1, 1)
+    >>> shutil.rmtree(directory)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.entries = marshal.load(f)
+
+    def stamp(self, filename):
+        stat = os.stat(filename)
+        return (stat.st_mtime, stat.st_size)
+
+    def get(self, filename):
+        entry = self.entries.get(filename)
+        if entry is None or entry[0] != self.stamp(filename):
+            return None
+        return entry[1], entry[2]
+
+    def put(self, filename, transitions, runs):
+        self.entries[filename] = (self.stamp(filename), transitions, runs)
+
+    def save(self, filenames=None):
+        """
+        Write the cache out, only keeping the given files if there are any
+        """
+        if filenames is not None:
+            keep = set(filenames)
+            self.entries = dict((filename, entry) for filename, entry in self.entries.iteritems() if filename in keep)
+        with open(self.path + '.tmp', 'wb') as f:
+            marshal.dump(self.entries, f)
+        os.rename(self.path + '.tmp', self.path)
+
+
+def corpus_sequences(filenames, processes=None, cache=None):
+    """
+    Add up the transitions and runs of every session in a corpus.  Sessions which aren't in the
+    SequenceCache (or have changed) are parsed and counted on a process pool, then merged into
+    the totals, which stay sparse since only codes which actually follow each other are counted.
+    
+    Returns (transitions, runs, errors): Counters like session_sequences, and a list of
+    (filename, error) for the files which couldn't be parsed and were left out.
+    
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> filenames = [_write_example(directory, 'a.csv'), _write_example(directory, 'm_bad.csv'),
+    ...              _write_example(directory, 'z.csv', ('0,x,,,', '2,x,,,'))]
+    >>> with open(filenames[1], 'w') as f:
+    ...     f.write('Observer: example\\n')
+    >>> transitions, runs, errors = corpus_sequences(filenames, processes=2)
+    >>> [(os.path.basename(filename), error) for filename, error in errors]
+    [('m_bad.csv', ValueError('The file is missing its header rows',))]
+    >>> sorted(runs.items())
+    [((('1. Instructor', 'CQ'), 2), 1), ((('1. Instructor', 'Lec'), 1), 2), ((('1. Instructor', 'Lec'), 2), 1), ((('2. Students', 'L'), 1), 1)]
+    >>> shutil.rmtree(directory)
+    """
+    # The filenames are needed again when the cache is saved, so they can't be a generator
+    filenames = list(filenames)
+    transitions = Counter()
+    runs = Counter()
+    errors = []
+    missing = []
+    for filename in filenames:
+        partial = cache.get(filename) if cache is not None else None
+        if partial is None:
+            missing.append(filename)
+        else:
+            transitions.update(partial[0])
+            runs.update(partial[1])
+    if processes == 1 or len(missing) < 2:
+        partials = itertools.imap(_session_sequences_file, missing)
+        pool = None
+    else:
+        processes = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        partials = pool.imap_unordered(_session_sequences_file, missing, max(1, len(missing) // (4 * processes)))
+    try:
+        for filename, session_transitions, session_runs, error in partials:
+            if error is not None:
+                errors.append((filename, error))
+                continue
+            transitions.update(session_transitions)
+            runs.update(session_runs)
+            if cache is not None:
+                cache.put(filename, session_transitions, session_runs)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if cache is not None and missing:
+        cache.save(filenames)
+    return transitions, runs, errors
+
+
+def sequences_output(transitions, runs, output):
+    """
+    Write the transition matrix as csv, a row for each code followed by a column for each code
+    it can be followed by, then a blank line and the run length counts for each code.
+    """
+    def label(column):
+        return '%s: %s' % (column[0], column[1].strip())
+    columns = sorted(set(itertools.chain.from_iterable(transitions)) | set(column for column, length in runs))
+    writer = csv.writer(output)
+    writer.writerow(['From / to'] + [label(column) for column in columns])
+    for from_column in columns:
+        writer.writerow([label(from_column)] + [transitions.get((from_column, to_column), 0) for to_column in columns])
+    writer.writerow([])
+    writer.writerow(['Code', 'Run length', 'Runs'])
+    for (column, length), count in sorted(runs.iteritems()):
+        writer.writerow([label(column), length, count])
+
+
+# Where the batch report workers write their reports
+_report_directory = None
+
+def _init_report_worker(observations, directory, align=None):
+    global _report_directory
+    _init_pair_worker(observations, align)
+    _report_directory = directory
+
+
+def _report_pair(pair):
+    """
+    Write the report for one pair of the shared observations
+    """
+    first, second = pair
+    eval1 = _pair_observations[first]
+    eval2 = _pair_observations[second]
+    agreement = total_agreement(eval1, eval2, _pair_align)
+    if agreement is None:
+        return pair, None, None
+    filename = report_filename(eval1.filename, eval2.filename)
+    pair_report(eval1, eval2, os.path.join(_report_directory, filename), REPORT_ASSETS, _pair_align)
+    return pair, filename, agreement
+
+
+def batch_reports(observations, directory, processes=None, align=None):
+    """
+    Write an html report for every pair of observations into a directory, on a process pool.
+    The style and chart options are written once as shared assets which every report links to,
+    and index.html links to all of the reports.  Pairs which can't be compared get no report.
+    
+    Returns the agreements in the same form as compare_all_pairs.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    write_report_assets(directory)
+    pairs = list(itertools.combinations(range(len(observations)), 2))
+    if processes == 1 or len(pairs) < 2:
+        _init_report_worker(observations, directory, align)
+        results = [_report_pair(pair) for pair in pairs]
+    else:
+        processes = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes, _init_report_worker, (observations, directory, align))
+        try:
+            results = pool.map(_report_pair, pairs, max(1, len(pairs) // (4 * processes)))
+        finally:
+            pool.close()
+            pool.join()
+    
+    with open(os.path.join(directory, 'index.html'), 'w') as f:
+        f.write("""<!DOCTYPE html>
+<html>
+<head>
+    <title>Observation reports</title>
+    <link rel="stylesheet" href="%s">
 </head>
 <body>
-"""
-    for id in column_chart_div_ids:
-        output += '<div id="%s" class="plot"></div>\n' % id
-    for id in pie_chart_div_ids:
-        output += '<div id="%s" class="pie"></div>\n' % id
-#    # Add divs for the plots
-#    for category, observations in eval1.categories.iteritems():
-#        for observation in observations:
-#            id = category + ': ' + observation
-#            output += '<div id="%s" style="width:700; height:100"></div>\n' % id
-#    
-#    for category in eval1.categories.keys():
-#        output += '<div id="%s" style="width:700; height:500"></div>\n' % category
-#        
-    # End the page
-    output += """</body>
-</html>"""
-    with open(output_file, 'w') as f:
-        f.write(output)
+<table>
+<tr><th>First</th><th>Second</th><th>Agreement</th></tr>
+""" % REPORT_ASSETS[0])
+        for (first, second), filename, agreement in results:
+            names = (cgi.escape(os.path.basename(observations[first].filename)),
+                     cgi.escape(os.path.basename(observations[second].filename)))
+            if filename is None:
+                f.write('<tr><td>%s</td><td>%s</td><td>NA</td></tr>\n' % names)
+            else:
+                f.write('<tr><td><a href="%s">%s</a></td><td>%s</td><td>%.2f%%</td></tr>\n'
+                        % ((urllib.quote(filename),) + names + (agreement,)))
+        f.write("""</table>
+</body>
+</html>""")
+    return dict((pair, agreement) for pair, filename, agreement in results)
+
+
+class ObservationWatcher(object):
+    """
+    Keep the observations in a directory, and the agreement between every pair of them, up to date.
+    
+    Each call to scan only re-parses the files which were added or changed since the last scan,
+    and only recompares the pairs which involve them.  Every other pair keeps its previous
+    result.  If report_directory is given, the html report for each recompared pair is written
+    there as first--second.html.
+    
+    A file which can't be parsed (say it is still being written) is left out until it changes
+    again, and so are its pairs.
+    
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> first = _write_example(directory, 'first.csv')
+    >>> second = _write_example(directory, 'second.csv', ('0,x,,,', '2,,x,,', '4,x,,,'))
+    >>> watcher = ObservationWatcher(directory)
+    >>> [os.path.basename(filename) for filename in watcher.scan()[0]]
+    ['first.csv', 'second.csv']
+    >>> output = StringIO()
+    >>> watcher.agreement_matrix(output)
+    >>> output.getvalue().splitlines()
+    [',first.csv,second.csv', 'first.csv,100.00,77.78', 'second.csv,77.78,100.00']
+    >>> with open(second, 'w') as f:
+    ...     f.write('Observer: example\\n')
+    >>> [os.path.basename(filename) for filename in watcher.scan()[1]]
+    ['second.csv']
+    >>> output = StringIO()
+    >>> watcher.agreement_matrix(output)
+    >>> output.getvalue().splitlines()
+    [',first.csv', 'first.csv,100.00']
+    >>> shutil.rmtree(directory)
+    """
+    def __init__(self, path, cache=None, report_directory=None, align=None):
+        self.path = path
+        self.cache = cache
+        self.report_directory = report_directory
+        self.align = align
+        self.stamps = {}
+        self.observations = {}
+        self.agreements = {}
+
+    def scan(self):
+        """
+        Look for added, changed and removed files and update the agreements for them.
+        Returns the lists of (changed, removed) files.
+        """
+        filenames = find_observation_files(self.path)
+        present = set(filenames)
+        removed = [filename for filename in self.stamps if filename not in present]
+        for filename in removed:
+            del self.stamps[filename]
+            self.drop(filename)
         
+        changed = []
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            stamp = (stat.st_mtime, stat.st_size)
+            if self.stamps.get(filename) == stamp:
+                continue
+            self.stamps[filename] = stamp
+            observation = TeacherObservation(filename, compact=True)
+            try:
+                observation.parse(self.cache)
+            except Exception as error:
+                # The file may still be being written, it will be picked up when it changes again
+                print >>sys.stderr, "Couldn't parse %s: %r" % (filename, error)
+                if filename in self.observations:
+                    self.drop(filename)
+                    removed.append(filename)
+                continue
+            self.observations[filename] = observation
+            changed.append(filename)
         
+        # Only the pairs with a changed file need comparing again
+        done = set()
+        for filename in changed:
+            for other in self.observations:
+                pair = tuple(sorted((filename, other)))
+                if other == filename or pair in done:
+                    continue
+                done.add(pair)
+                self.agreements[pair] = total_agreement(self.observations[pair[0]], self.observations[pair[1]], self.align)
+                if self.report_directory and self.agreements[pair] is not None:
+                    self.write_report(*pair)
+        return changed, removed
+
+    def drop(self, filename):
+        """
+        Forget a file's observation, along with its agreements and reports
+        """
+        self.observations.pop(filename, None)
+        for pair in self.agreements.keys():
+            if filename in pair:
+                del self.agreements[pair]
+                if self.report_directory and os.path.exists(self.report_path(*pair)):
+                    os.remove(self.report_path(*pair))
+
+    def report_path(self, first, second):
+        """
+        Where the html report for a pair of files goes
+        """
+        return os.path.join(self.report_directory, report_filename(first, second))
+
+    def write_report(self, first, second):
+        """
+        Write the html report for one pair of files
+        """
+        if not os.path.exists(os.path.join(self.report_directory, REPORT_ASSETS[1])):
+            write_report_assets(self.report_directory)
+        pair_report(self.observations[first], self.observations[second],
+                    self.report_path(first, second), REPORT_ASSETS, self.align)
+
+    def agreement_matrix(self, output):
+        """
+        Write the current agreement matrix as csv
+        """
+        filenames = sorted(self.observations)
+        index = dict((filename, position) for position, filename in enumerate(filenames))
+        agreements = dict(((index[first], index[second]), agreement)
+                          for (first, second), agreement in self.agreements.iteritems())
+        agreement_matrix_output(filenames, agreements, output)
+
+    def watch(self, interval=2.0, matrix_file=None):
+        """
+        Scan forever, rewriting the agreement matrix whenever something changes
+        """
+        while True:
+            changed, removed = self.scan()
+            if changed or removed:
+                for filename in changed:
+                    print "Updated %s" % filename
+                for filename in removed:
+                    print "Removed %s" % filename
+                if matrix_file:
+                    with open(matrix_file, 'wb') as f:
+                        self.agreement_matrix(f)
+                else:
+                    self.agreement_matrix(sys.stdout)
+                sys.stdout.flush()
+            time.sleep(interval)
+
+
+class SessionCache(object):
+    """
+    Parsed observations kept in memory, keyed by the sha1 of their contents, so a file which has
+    been seen before doesn't have to be parsed again however it is named.  Once the contents of
+    the cached sessions add up to more than max_bytes, the least recently used are dropped.
+    Safe to share between threads; files are parsed outside of the lock.
+    """
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, digest):
+        """
+        The observation with this content hash, or None if it isn't cached
+        """
+        with self.lock:
+            entry = self.sessions.pop(digest, None)
+            if entry is None:
+                return None
+            self.sessions[digest] = entry
+            return entry[0]
+
+    def add(self, filename, data):
+        """
+        Parse the contents of an observation file, unless they are already cached.
+        Returns (content hash, observation).
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        observation = self.get(digest)
+        if observation is not None:
+            return digest, observation
+        observation = TeacherObservation.from_file(filename, StringIO(data), compact=True)
+        with self.lock:
+            if digest not in self.sessions:
+                self.sessions[digest] = (observation, len(data))
+                self.size += len(data)
+            while self.size > self.max_bytes and len(self.sessions) > 1:
+                evicted, (evicted_observation, evicted_size) = self.sessions.popitem(last=False)
+                self.size -= evicted_size
+        return digest, observation
+
+
+class ServiceError(Exception):
+    """
+    A request the comparison service can't answer, with the HTTP status to send back
+    """
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class ComparisonServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server for comparing observations without starting the script each time.
+    Each request gets its own thread, and they all share one SessionCache.  Observation
+    paths are only read from inside root.
+    
+    >>> import tempfile, shutil, json, urllib2
+    >>> directory = tempfile.mkdtemp()
+    >>> filename = _write_example(directory, 'first.csv')
+    >>> empty = _write_example(directory, 'empty.csv', ('0,,,,', '2,,,,'))
+    >>> server = ComparisonServer(('127.0.0.1', 0), root=directory)
+    >>> thread = threading.Thread(target=server.serve_forever)
+    >>> thread.start()
+    >>> def request(path, body=None):
+    ...     try:
+    ...         response = urllib2.urlopen('http://127.0.0.1:%d%s' % (server.server_address[1], path), body)
+    ...     except urllib2.HTTPError as response:
+    ...         pass
+    ...     return response.code, json.load(response)
+    >>> status, session = request('/sessions?name=second.csv', open(filename).read())
+    >>> status, session['filled_time_blocks']
+    (200, 3)
+    >>> status, result = request('/compare', json.dumps({'first': 'first.csv', 'second': session['session']}))
+    >>> status, result['agreement'], result['records'][-1]['level']
+    (200, 100.0, u'total')
+    >>> request('/compare?first=empty.csv&second=empty.csv&report=1')[0]
+    200
+    >>> request('/sessions', 'Observer: example')[0], request('/compare', '[]')[0]
+    (400, 400)
+    >>> request('/compare?first=../first.csv&second=first.csv')[0]
+    404
+    >>> server.shutdown()
+    >>> server.server_close()
+    >>> shutil.rmtree(directory)
+    """
+    daemon_threads = True
+
+    def __init__(self, address, cache=None, root='.', align=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ComparisonHandler)
+        self.cache = cache if cache is not None else SessionCache()
+        self.root = os.path.realpath(root)
+        self.align = align
+
+
+class ComparisonHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    The requests the comparison service answers, all with JSON:
+    
+        POST /sessions?name=FILE         the body is an observation file; returns its session hash
+        GET  /sessions/HASH              the filename, times and codes of a cached session
+        GET  /compare?first=A&second=B   compare two sessions, given as hashes or paths
+        POST /compare                    the same, with a JSON body like the query
+    
+    A comparison can also have align (overlap or fill) and report=1 for the charts as an html
+    fragment, which needs REPORT_ASSETS, served as /teacherobservations.css and .js.
+    The comparison has the stats of every code, category and the totals as in
+    ComparisonResult.records.
+    """
+    server_version = 'TeacherObservations/1.0'
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, value):
+        import json
+        self.send_body(status, 'application/json', json.dumps(value))
+
+    def handle_request(self, method):
+        import json
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        try:
+            if method == 'POST':
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    raise ServiceError(400, "Bad Content-Length")
+                body = self.rfile.read(length)
+            if url.path in ('/' + name for name in REPORT_ASSETS) and method == 'GET':
+                content_type = 'text/css' if url.path.endswith('.css') else 'application/javascript'
+                self.send_body(200, content_type, REPORT_STYLE if url.path.endswith('.css') else REPORT_SCRIPT)
+            elif url.path == '/sessions' and method == 'POST':
+                digest, observation = self.parse(query.get('name', 'upload.csv'), body)
+                self.send_json(200, self.session_info(digest, observation))
+            elif url.path.startswith('/sessions/') and method == 'GET':
+                digest = url.path[len('/sessions/'):]
+                self.send_json(200, self.session_info(digest, self.session(digest)))
+            elif url.path == '/compare':
+                if method == 'POST':
+                    try:
+                        query = json.loads(body)
+                    except ValueError:
+                        raise ServiceError(400, "The body isn't JSON")
+                    if not isinstance(query, dict):
+                        raise ServiceError(400, "The body should be a JSON object")
+                self.send_json(200, self.compare(query))
+            else:
+                raise ServiceError(404, "Nothing at %s %s" % (method, url.path))
+        except ServiceError as error:
+            self.send_json(error.status, {'error': str(error)})
+        except Exception as error:
+            # Anything else is a bug, but the client still gets an answer
+            self.log_error("Error answering %s %s: %r", method, self.path, error)
+            self.send_json(500, {'error': repr(error)})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def session_info(self, digest, observation):
+        return {'session': digest,
+                'filename': observation.filename,
+                'times': observation.times,
+                'filled_time_blocks': observation.filled_time_intervals,
+                'categories': observation.categories}
+
+    def parse(self, filename, data):
+        """
+        Parse (or find in the cache) the contents of an observation file
+        """
+        try:
+            return self.server.cache.add(filename, data)
+        except Exception as error:
+            raise ServiceError(400, "Couldn't parse %s: %r" % (filename, error))
+
+    def session(self, reference):
+        """
+        Find an observation from a session hash or a path inside the server's root
+        """
+        if reference is None:
+            raise ServiceError(400, "Two sessions are needed to compare, as first and second")
+        observation = self.server.cache.get(reference)
+        if observation is not None:
+            return observation
+        path = os.path.realpath(os.path.join(self.server.root, reference))
+        if not path.startswith(os.path.join(self.server.root, '')) or not os.path.isfile(path):
+            raise ServiceError(404, "No session or file %s" % reference)
+        with open(path, 'rb') as f:
+            data = f.read()
+        return self.parse(reference, data)[1]
+
+    def compare(self, query):
+        eval1 = self.session(query.get('first'))
+        eval2 = self.session(query.get('second'))
+        align = query.get('align', self.server.align)
+        if align not in (None, 'overlap', 'fill'):
+            raise ServiceError(400, "align should be overlap or fill")
+        if eval1.categories != eval2.categories:
+            raise ServiceError(409, "The categories do not match")
+        if eval1.times != eval2.times and align is None:
+            raise ServiceError(409, "The times do not match, use align to compare them anyway")
+        result = compare_observations(eval1, eval2, align)
+        response = {'first': eval1.filename,
+                    'second': eval2.filename,
+                    'agreement': result.agreement,
+                    'time_blocks': result.time_blocks,
+                    'coverage': result.coverage and result.coverage._asdict(),
+                    'records': [dict(zip(ComparisonResult.FIELDS, record)) for record in result.records()]}
+        if query.get('report') not in (None, False, '', '0'):
+            if align is not None and eval1.times != eval2.times:
+                eval1, eval2, coverage = align_observations(eval1, eval2, fill_gaps=(align == 'fill'))
+            response['report'] = html_fragment(eval1, eval2, result.category_results(), result.time_blocks)
+        return response
+
+
+def serve(port, host='127.0.0.1', cache=None, root='.', align=None):
+    """
+    Run the comparison service until it is interrupted
+    """
+    server = ComparisonServer((host, port), cache, root, align)
+    print "Serving comparisons on http://%s:%d/" % server.server_address
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Parse, compare, and analyze \
     teaching observations")
-    parser.add_argument("csvfile", nargs=2, help="A space separated \
+    parser.add_argument("csvfile", nargs='*', help="A space separated \
     list of the filenames.  Only the first two will be read.")
     parser.add_argument('-t', '--test', action='store_true', help="Run the tests instead of running the program")
     parser.add_argument('-o', '--output', nargs=1, help="Produce a quick and dirty html page with bar graphs.")
+    parser.add_argument('-c', '--compact', action='store_true', help="Store the parsed observations as a compact bit matrix")
+    parser.add_argument('-b', '--batch', help="Compare every pair of observations in a directory or glob and print an agreement matrix")
+    parser.add_argument('--threads', type=int, default=8, help="The number of threads used to read files in batch mode")
+    parser.add_argument('-j', '--processes', type=int, help="The number of worker processes for batch mode (defaults to the number of cpus)")
+    parser.add_argument('--timings', help="Write the time spent in each stage, with rows, cells and bytes processed, to this file as JSON (- for the screen)")
+    def stage_and_file(value):
+        stage, colon, filename = value.partition(':')
+        if not (stage and colon and filename):
+            parser.error("--profile needs a stage and a file, such as parse_rows:parse.prof")
+        return stage, filename
+    parser.add_argument('--profile', type=stage_and_file, metavar='STAGE:FILE', help="Run a stage (read, parse_categories, parse_rows, cache_load, compare or html) under cProfile and dump the stats to FILE")
+    parser.add_argument('--align', choices=['overlap', 'fill'], help="Compare observations whose times don't match, using only the time blocks they share (overlap) or every time block, with missing ones counted as empty (fill)")
+    parser.add_argument('-k', '--tolerance', type=int, default=0, help="Also show the agreement when marks up to this many time blocks apart count as matching")
+    parser.add_argument('--reliability', type=int, metavar='REPLICATES', help="Also show Cohen's kappa, PABAK and Krippendorff's alpha, with confidence intervals from this many bootstrap replicates")
+    parser.add_argument('--seed', type=int, help="The random seed for the bootstrap")
+    parser.add_argument('--cache', help="Keep parsed observations in this directory, so unchanged files aren't parsed again")
+    parser.add_argument('--cache-size', type=int, default=64, help="The maximum size of the cache in megabytes")
+    parser.add_argument('-s', '--stream', help="Stream an observation file (- for standard input), printing each time block as it is read")
+    parser.add_argument('-r', '--reports', help="In batch mode, also write an html report for every pair into this directory, with an index page")
+    parser.add_argument('-a', '--archive', help="Write the observations found by --batch into a single archive file instead of comparing them.  --batch can also read an archive.")
+    parser.add_argument('-w', '--watch', help="Watch a directory of observations, recomparing files as they are added or changed.  With --output, the pair reports are written to that directory.")
+    parser.add_argument('--interval', type=float, default=2.0, help="How often to check the watched directory, in seconds")
+    parser.add_argument('-m', '--matrix', help="Write the batch agreement matrix to this file instead of the screen")
+    parser.add_argument('--jsonl', help="Write the stats for every code, category and the totals to this file as JSON Lines (- for the screen)")
+    parser.add_argument('--csv-out', help="Write the stats for every code, category and the totals to this file as csv (- for the screen)")
+    parser.add_argument('--ingest', metavar='DATABASE', help="Store the observation files given (or found by --batch) in this SQLite database instead of comparing them")
+    parser.add_argument('--metadata', action='append', default=[], metavar='FIELD=VALUE', help="Session, observer, teacher or date to store the ingested files with, can be given more than once")
+    parser.add_argument('--sequences', metavar='PATH', help="Count the code transitions and run lengths over every observation in a directory or glob, writing them as csv (to --matrix or the screen)")
+    parser.add_argument('--sequence-cache', metavar='FILE', help="Keep each session's transitions and run lengths in this file, so only new or changed sessions are counted again")
+    parser.add_argument('--serve', type=int, metavar='PORT', help="Run a local HTTP service answering comparisons with JSON, keeping parsed sessions in memory (up to --cache-size megabytes of files)")
+    parser.add_argument('--host', default='127.0.0.1', help="The address for --serve to listen on")
+    parser.add_argument('--root', default='.', help="The directory --serve reads observation paths from")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Don't print the comparison (or the batch agreement matrix without --matrix)")
     args = parser.parse_args()
+    timings = None
+    if args.timings:
+        timings = StageTimings()
+        add_timing_hook(timings)
+    if args.profile:
+        profile_stage(*args.profile)
+    def write_results(results):
+        for filename, writer in ((args.jsonl, write_comparisons_jsonl), (args.csv_out, write_comparisons_csv)):
+            if filename == '-':
+                writer(results, sys.stdout)
+            elif filename:
+                with open(filename, 'wb') as f:
+                    writer(results, f)
+    
+    cache = None
+    if args.cache:
+        cache = ParseCache(args.cache, args.cache_size*1024*1024)
     if args.test:
         import doctest
         doctest.testmod()
+    elif args.serve:
+        try:
+            serve(args.serve, args.host, SessionCache(args.cache_size*1024*1024), args.root, args.align)
+        except KeyboardInterrupt:
+            pass
+    elif args.watch:
+        report_directory = None
+        if args.output:
+            report_directory = args.output[0]
+            if not os.path.isdir(report_directory):
+                os.makedirs(report_directory)
+        watcher = ObservationWatcher(args.watch, cache, report_directory, args.align)
+        try:
+            watcher.watch(args.interval, args.matrix)
+        except KeyboardInterrupt:
+            pass
+    elif args.stream:
+        if args.stream == '-':
+            csvfile = sys.stdin
+        else:
+            csvfile = open(args.stream, 'rb')
+        stream = ObservationStream(csvfile)
+        for block in stream:
+            print "%s, %d, %s" % (block.time, stream.totals.filled_time_intervals,
+                                  ' '.join(['%s: %s' % column for column in stream.active_codes(block)]))
+        print "Filled time blocks: %d of %d" % (stream.totals.filled_time_intervals, stream.totals.time_blocks)
+    elif args.ingest:
+        metadata = dict(field.split('=', 1) for field in args.metadata)
+        filenames = find_observation_files(args.batch) if args.batch else args.csvfile
+        observations = []
+        for result in load_observations(filenames, args.threads, cache=cache):
+            if result.error is not None:
+                print >>sys.stderr, "Skipping %s: %r" % (result.filename, result.error)
+            else:
+                observations.append(result.observation)
+        with ObservationStore(args.ingest) as store:
+            file_ids = store.ingest_many(observations, **metadata)
+        if not args.quiet:
+            for observation, file_id in zip(observations, file_ids):
+                print "%d: %s" % (file_id, observation.filename)
+    elif args.sequences:
+        sequence_cache = SequenceCache(args.sequence_cache) if args.sequence_cache else None
+        transitions, runs, errors = corpus_sequences(find_observation_files(args.sequences), args.processes, sequence_cache)
+        for filename, error in errors:
+            print >>sys.stderr, "Skipping %s: %r" % (filename, error)
+        if args.matrix:
+            with open(args.matrix, 'wb') as f:
+                sequences_output(transitions, runs, f)
+        else:
+            sequences_output(transitions, runs, sys.stdout)
+    elif args.batch:
+        if CorpusArchive.is_archive(args.batch):
+            with CorpusArchive(args.batch) as archive:
+                observations = list(archive)
+            filenames = [observation.filename for observation in observations]
+        else:
+            observations = []
+            for result in load_observations(find_observation_files(args.batch), args.threads, cache=cache):
+                if result.error is not None:
+                    print >>sys.stderr, "Skipping %s: %r" % (result.filename, result.error)
+                else:
+                    observations.append(result.observation)
+            observations.sort(key=lambda observation: observation.filename)
+            filenames = [observation.filename for observation in observations]
+        if args.archive:
+            write_corpus_archive(args.archive, observations)
+            sys.exit()
+        if len(observations) < 2:
+            raise IOError("Found fewer than two observations in %s" % args.batch)
+        if args.reports:
+            agreements = batch_reports(observations, args.reports, args.processes, args.align)
+        elif args.jsonl or args.csv_out:
+            results = compare_all_pairs(observations, args.processes, args.align, details=True)
+            write_results([results[pair] for pair in sorted(results) if results[pair] is not None])
+            agreements = dict((pair, result and result.agreement) for pair, result in results.iteritems())
+        else:
+            agreements = compare_all_pairs(observations, args.processes, args.align)
+        if args.matrix:
+            with open(args.matrix, 'wb') as f:
+                agreement_matrix_output(filenames, agreements, f)
+        elif not args.quiet:
+            agreement_matrix_output(filenames, agreements, sys.stdout)
     else:
+        if len(args.csvfile) < 2:
+            parser.error("Two observation files are needed to compare")
         for csvfile in args.csvfile:
             if not (os.path.exists(csvfile)):
                 raise IOError("File %s does not exist" % csvfile)
         csv1 = args.csvfile[0]
-        TE1 = TeacherObservation(csv1)
-        TE1.parse()
+        TE1 = TeacherObservation(csv1, compact=args.compact)
+        TE1.parse(cache)
         
         csv2 = args.csvfile[1]
-        TE2 = TeacherObservation(csv2)
-        TE2.parse()
+        TE2 = TeacherObservation(csv2, compact=args.compact)
+        TE2.parse(cache)
         
-        cnt, category_result, total_time_blocks = compare_teacher_evals(TE1, TE2)
+        if args.jsonl or args.csv_out:
+            result = compare_observations(TE1, TE2, args.align)
+            if not args.quiet:
+                result.print_report()
+            write_results([result])
+            cnt, category_result, total_time_blocks = result.as_tuple()
+        else:
+            cnt, category_result, total_time_blocks = compare_teacher_evals(TE1, TE2, args.align, quiet=args.quiet)
+        if args.align is not None and TE1.times != TE2.times:
+            TE1, TE2, coverage = align_observations(TE1, TE2, fill_gaps=(args.align == 'fill'))
+        if args.tolerance and not args.quiet:
+            print_tolerance_agreement(TE1, TE2, args.tolerance)
+        if args.reliability:
+            print_reliability(*reliability_suite(TE1, TE2, args.reliability, seed=args.seed, processes=args.processes))
         if args.output:
             html_output(TE1, TE2, args.output[0], category_result, total_time_blocks)
     
+    if timings is not None:
+        if args.timings == '-':
+            print >>sys.stderr, timings.to_json()
+        else:
+            with open(args.timings, 'w') as f:
+                f.write(timings.to_json())
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Benchmarks for parsing, comparing and reporting on teaching observations.
+
+Synthetic observation files are generated with the same layout as the real spreadsheets
+(a discarded first line, the broad categories row, the code row starting with MIN, and a
+Comments column at the end) at a few sizes, and each stage is timed on them.  Every benchmark
+runs in its own process, so the peak memory reported is just that benchmark's.
+
+    python benchmark.py
+    python benchmark.py --scale 2000 60 0.2 --json results.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+import multiprocessing
+
+from TeacherObservations import TeacherObservation, compare_teacher_evals, count_filled_time_intervals, html_output
+
+# (time blocks, codes, fill density)
+DEFAULT_SCALES = [(30, 28, 0.2), (500, 28, 0.2), (5000, 60, 0.2), (20000, 120, 0.1)]
+
+BROAD_CATEGORIES = ['1. Instructor doing', '2. Students doing', '3. Engagement']
+
+
+def write_synthetic_observation(filename, time_blocks, codes, density, seed=0):
+    """
+    Write a random observation file with the given number of time blocks and codes.
+    The codes are split between the broad categories, and each cell is marked with
+    probability density.
+    """
+    generator = random.Random(seed)
+    per_category = [codes // len(BROAD_CATEGORIES)] * len(BROAD_CATEGORIES)
+    per_category[0] += codes - sum(per_category)
+    broad_row = ['']
+    code_row = ['MIN']
+    for category, count in zip(BROAD_CATEGORIES, per_category):
+        for index in range(count):
+            broad_row.append(category if index == 0 else '')
+            code_row.append('%s%d' % (category[3], index))
+    broad_row.append('Comments')
+    code_row.append('')
+    with open(filename, 'wb') as f:
+        f.write('Observer: synthetic\n')
+        f.write(','.join(broad_row) + '\n')
+        f.write(','.join(code_row) + '\n')
+        for block in range(time_blocks):
+            cells = ['x' if generator.random() < density else '' for index in range(codes)]
+            comment = 'note' if generator.random() < 0.05 else ''
+            f.write(','.join(['%d-%d' % (2*block, 2*block + 2)] + cells + [comment]) + '\n')
+
+
+def _parse(filename, compact=False):
+    observation = TeacherObservation(filename, compact)
+    observation.parse()
+    return observation
+
+
+def _compare(first, second):
+    eval1 = _parse(first)
+    eval2 = _parse(second)
+    # The comparison prints a report, which isn't what we're timing
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        result = compare_teacher_evals(eval1, eval2)
+        return time.time() - start, result
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def bench_parse(first, second, output):
+    start = time.time()
+    _parse(first)
+    return time.time() - start
+
+
+def bench_parse_compact(first, second, output):
+    start = time.time()
+    _parse(first, compact=True)
+    return time.time() - start
+
+
+def bench_count_filled(first, second, output):
+    observation = _parse(first)
+    observations = []
+    for results in observation.results.itervalues():
+        observations.extend(results.values())
+    start = time.time()
+    count_filled_time_intervals(observations)
+    return time.time() - start
+
+
+def bench_compare(first, second, output):
+    elapsed, result = _compare(first, second)
+    return elapsed
+
+
+def bench_html(first, second, output):
+    eval1 = _parse(first)
+    eval2 = _parse(second)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        cnt, category_result, time_blocks = compare_teacher_evals(eval1, eval2)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    start = time.time()
+    html_output(eval1, eval2, output, category_result, time_blocks)
+    return time.time() - start
+
+
+BENCHMARKS = [
+    ('parse', bench_parse),
+    ('parse_compact', bench_parse_compact),
+    ('count_filled_time_intervals', bench_count_filled),
+    ('compare_teacher_evals', bench_compare),
+    ('html_output', bench_html),
+]
+
+
+def _run_in_child(function, args, results):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    elapsed = function(*args)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, after - before))
+
+
+def run_benchmark(function, args, repeat):
+    """
+    Run a benchmark repeat times, each in a fresh process.
+    Returns the best time in seconds and the largest peak memory growth in kilobytes.
+    """
+    times = []
+    peaks = []
+    for attempt in range(repeat):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_in_child, args=(function, args, results))
+        process.start()
+        elapsed, peak = results.get()
+        process.join()
+        times.append(elapsed)
+        peaks.append(peak)
+    return min(times), max(peaks)
+
+
+def run(scales, repeat=3, benchmarks=None):
+    directory = tempfile.mkdtemp(prefix='teacherobservations-bench-')
+    records = []
+    try:
+        for time_blocks, codes, density in scales:
+            first = os.path.join(directory, 'first.csv')
+            second = os.path.join(directory, 'second.csv')
+            write_synthetic_observation(first, time_blocks, codes, density, seed=1)
+            write_synthetic_observation(second, time_blocks, codes, density, seed=2)
+            output = os.path.join(directory, 'report.html')
+            file_bytes = os.path.getsize(first)
+            for name, function in BENCHMARKS:
+                if benchmarks and name not in benchmarks:
+                    continue
+                elapsed, peak = run_benchmark(function, (first, second, output), repeat)
+                record = {'benchmark': name,
+                          'time_blocks': time_blocks,
+                          'codes': codes,
+                          'density': density,
+                          'seconds': elapsed,
+                          'cells_per_second': time_blocks*codes/elapsed if elapsed else None,
+                          'peak_kb': peak,
+                          'file_bytes': file_bytes}
+                if name == 'html_output':
+                    record['output_bytes'] = os.path.getsize(output)
+                records.append(record)
+                print "%-28s %6d blocks %4d codes %5.2f density  %9.4fs  %12.0f cells/s  %8d KB peak" % (
+                    name, time_blocks, codes, density, elapsed, record['cells_per_second'] or 0, peak)
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark parsing, comparing and reporting on teaching observations")
+    parser.add_argument('-s', '--scale', nargs=3, action='append', metavar=('BLOCKS', 'CODES', 'DENSITY'),
+                        help="A size to benchmark at, can be given more than once (defaults to a range of sizes)")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Run each benchmark this many times and keep the best")
+    parser.add_argument('-b', '--benchmark', action='append', choices=[name for name, function in BENCHMARKS],
+                        help="Only run this benchmark, can be given more than once")
+    parser.add_argument('-j', '--json', help="Also write the results to this file as JSON")
+    parser.add_argument('-g', '--generate', nargs=4, metavar=('FILE', 'BLOCKS', 'CODES', 'DENSITY'),
+                        help="Just write a synthetic observation file")
+    args = parser.parse_args()
+    if args.generate:
+        filename, time_blocks, codes, density = args.generate
+        write_synthetic_observation(filename, int(time_blocks), int(codes), float(density))
+    else:
+        if args.scale:
+            scales = [(int(time_blocks), int(codes), float(density)) for time_blocks, codes, density in args.scale]
+        else:
+            scales = DEFAULT_SCALES
+        records = run(scales, args.repeat, args.benchmark)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(records, f, indent=2)